@@ -0,0 +1,128 @@
+import os
+import numpy as np
+
+try:
+    import pygrib
+except ImportError:
+    pygrib = None
+
+######################################################################
+#   Array Store                                                      #
+#                                                                    #
+#   decodes every GRIB in a model cycle once, into one contiguous    #
+#   .npy file per cycle laid out as                                  #
+#       member x fhour x level x lat x lon                           #
+#   with a record of TMP/RH/UGRD/VGRD/VVEL at each point, so a       #
+#   sounding is a zero-copy slice of a memory map:                   #
+#       data, coords = openCycleArray(manager, 'GEFS', '2022101500') #
+#       profile = data[member, fhour, :, y, x]   # every level, var  #
+#       temps = data['TMP'][:, fhour, :, y, x]   # every member      #
+#                                                                    #
+#   needs pygrib to build arrays (not to read them)                  #
+######################################################################
+
+# the variables and pressure levels (mb) pulled from NOMADS by the url patterns in the config
+VARIABLES = ('TMP', 'RH', 'UGRD', 'VGRD', 'VVEL')
+LEVELS = (1000, 925, 850, 700, 500, 300, 250, 200, 100, 50, 10)
+
+# pygrib/ecCodes short names for the variables above
+SHORT_NAMES = {'t': 'TMP', 'r': 'RH', 'u': 'UGRD', 'v': 'VGRD', 'w': 'VVEL'}
+
+# one grid point's worth of data
+POINT = np.dtype([(variable, np.float32) for variable in VARIABLES])
+
+
+# returns the paths (array, coordinates) a model cycle's decoded arrays are written to...inside the cycle directory, so purging the
+# cycle takes them with it
+def arrayPaths(manager, model, cyclec):
+    cycleDir = os.path.join(manager.constants['rootSrc'], model, cyclec)
+    return (os.path.join(cycleDir, model + '.' + cyclec + '.npy'), os.path.join(cycleDir, model + '.' + cyclec + '.coords.npz'))
+
+
+# decodes every GRIB of a model cycle into its array file and registers it with the manager
+# anything missing from the cycle is left as NaN
+# returns the path to the array file, or None if the cycle has no GRIBs
+def buildCycleArray(manager, model, cyclec):
+    if pygrib is None:
+        raise ImportError('pygrib is needed to decode GRIBs into the array store')
+
+    inventory = manager.getInventoryFrame(model=model, cycle=cyclec)
+    if len(inventory) == 0:
+        return None
+
+    inc = manager.models[model]['increment']
+    members = np.array([-1] + list(range(1, manager.models[model]['members'] + 1)))
+    fHours = np.arange(0, manager.models[model]['fHours'] + inc, inc)
+    levels = np.array(manager.constants.get('arrayLevels', LEVELS))
+    lats, lons = _gridOf(inventory['path'].iloc[0])
+
+    arrayPath, coordsPath = arrayPaths(manager, model, cyclec)
+    tempPath = arrayPath + '.part.npy' # open_memmap insists on the .npy extension
+    data = np.lib.format.open_memmap(tempPath, mode='w+', dtype=POINT, shape=(len(members), len(fHours), len(levels), len(lats), len(lons)))
+    for variable in VARIABLES:
+        data[variable] = np.nan
+
+    present = inventory[['member', 'fhour']].to_numpy()
+    memberIndex = np.searchsorted(members, present[:, 0])
+    fHourIndex = np.searchsorted(fHours, present[:, 1])
+    # skip anything outside the configured members/forecast hours (e.g. left over from an older config)
+    valid = (memberIndex < len(members)) & (fHourIndex < len(fHours))
+    valid[valid] = (members[memberIndex[valid]] == present[valid, 0]) & (fHours[fHourIndex[valid]] == present[valid, 1])
+    levelIndex = {int(level): i for i, level in enumerate(levels)}
+    for path, m, f in zip(inventory['path'][valid], memberIndex[valid], fHourIndex[valid]):
+        for variable, level, values in _decode(path):
+            if level in levelIndex:
+                data[variable][m, f, levelIndex[level]] = values
+
+    # same publish-atomically dance as downloads...flush to disk, then rename into place
+    data.flush()
+    del data
+    np.savez(coordsPath + '.part.npz', members=members, fhours=fHours, levels=levels, lats=lats, lons=lons)
+    os.replace(coordsPath + '.part.npz', coordsPath)
+    os.replace(tempPath, arrayPath)
+
+    manager.registerArray(model, cyclec, arrayPath, coordsPath, len(inventory))
+    return arrayPath
+
+
+# opens a model cycle's array file as a read-only memory map
+# returns (data, coords), where coords holds the members/fhours/levels/lats/lons each axis corresponds to, or None if there's no array
+def openCycleArray(manager, model, cyclec):
+    record = manager.getArray(model, cyclec)
+    if record is None:
+        return None
+    arrayPath, coordsPath, gribCount = record
+    data = np.load(arrayPath, mmap_mode='r')
+    with np.load(coordsPath) as coords:
+        return (data, {key: coords[key] for key in coords.files})
+
+
+# returns the 1-D latitudes and longitudes of the (regular lat/lon) grid in a GRIB
+def _gridOf(path):
+    with pygrib.open(path) as grbs:
+        lats, lons = grbs.message(1).latlons()
+    return (lats[:, 0], lons[0, :])
+
+
+# yields (variable, level, 2-D values) for every isobaric TMP/RH/UGRD/VGRD/VVEL message in a GRIB
+def _decode(path):
+    with pygrib.open(path) as grbs:
+        for grb in grbs:
+            variable = SHORT_NAMES.get(grb.shortName)
+            if variable is None or grb.typeOfLevel != 'isobaricInhPa':
+                continue
+            yield (variable, int(grb.level), np.ma.filled(grb.values, np.nan).astype(np.float32))
+
+
+# returns the profile at the grid point nearest (lat, lon) in a single GRIB, as variable -> {level: value}
+# for one-off reads (e.g. rendering a sounding) where building the whole cycle's array file would be overkill
+def readProfile(path, lat, lon):
+    if pygrib is None:
+        raise ImportError('pygrib is needed to decode GRIBs')
+    lats, lons = _gridOf(path)
+    y = int(np.abs(lats - lat).argmin())
+    x = int(np.abs((lons - lon + 180) % 360 - 180).argmin()) # nearest on the circle, so -100 and 260 are the same place
+    profile = {variable: {} for variable in VARIABLES}
+    for variable, level, values in _decode(path):
+        profile[variable][level] = float(values[y, x])
+    return profile
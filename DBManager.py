@@ -3,11 +3,22 @@ import pandas as pd
 import sqlite3 as sq
 import urllib.request as url
 import os
+import shutil
+import subprocess
+import time
+import heapq
+import random
+import threading
+from collections import deque
 import yaml
 from datetime import datetime, timedelta
 from urllib.error import HTTPError
 from urllib.error import URLError
 from socket import timeout
+from http.client import HTTPException
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from SyncMetrics import SyncMetrics
+from HTTPSession import HTTPSession
 
 ######################################################################
 #   Database Management v1.0                                     #
@@ -21,47 +32,253 @@ from socket import timeout
 class DBManager:
 
 
-    def __init__(self, db_config):
+    # shareWith is another DBManager (on the same config) whose NOMADS session, circuit breaker, bandwidth/concurrency budget, write lock
+    # and metrics this one should share...that's how GribManager runs one DBManager per model side by side without going over NOMADS' limits
+    def __init__(self, db_config, cache=None, shareWith=None):
         with open(db_config, 'r') as configFile:
             config = yaml.safe_load(configFile)
+        self.configPath = db_config
         self.constants = config['constants']
         #self.constants['dbname'] = dbfile
         self.models = config['models']
         self.urlPatterns = config['urlPatterns']
-        self.conn = sq.connect(self.constants['dbname'])
-        self.curs = self.conn.cursor()
-        self.curs.execute('CREATE TABLE if not exists grib (model TEXT, cycle TEXT, member INTEGER, fhour INTEGER, path TEXT, validTime TEXT)')
+        self.shared = shareWith is not None
+        if shareWith is None:
+            self.metrics = SyncMetrics() # per-model/per-cycle counters and latency histograms, see SyncMetrics.py
+            self.writeLock = threading.Lock() # serializes inventory commits across every DBManager sharing it
+        else:
+            self.metrics = shareWith.metrics
+            self.writeLock = shareWith.writeLock
+        # one writer connection, plus a read-only connection per thread for lookups...see ConnectionManager below
+        self.connections = ConnectionManager(self.constants['dbname'], self.writeLock)
+        self.conn = self.connections.writer
+        self.__migrateSchema() # bring the tables/indexes up to the current schema version
+        # all inventory inserts/deletes go through the writer, which batches them into as few transactions as possible
+        self.writer = InventoryWriter(self.conn, self.constants.get('batchSize', 500), self.constants.get('batchSeconds', 5.0), self.metrics, self.writeLock)
+
+        # optional in-memory copy of the grib inventory, so checkForFile()/getModelCycles() don't need a SQL round-trip
+        # turned on with cache=True or the 'inventoryCache' constant in the config
+        if cache is None:
+            cache = self.constants.get('inventoryCache', False)
+        self.inventory = None # (model, cycle, member, fhour) -> path
+        self.cycleCounts = None # (model, cycle) -> number of GRIBs held for that cycle
+        if cache:
+            self.loadInventory()
+
+        # results of recent NOMADS availability probes, (model, cycle, member, fhour) -> (available, expiry)
+        # positive results never expire on their own (they're dropped when the cycle is purged), negative ones expire after probeBackoff seconds
+        self.probeCache = {}
+
+        if shareWith is None:
+            # every request to NOMADS goes through this keep-alive connection pool...by default it allows one connection per download worker
+            self.session = HTTPSession(self.constants.get('connectionsPerHost', max(self.constants.get('workers', 1), 1)), self.constants.get('timeout', 30))
+            # shared by every request to NOMADS, see CircuitBreaker below
+            self.breaker = CircuitBreaker(self.constants.get('breakerWindow', 20), self.constants.get('breakerThreshold', 0.5), self.constants.get('breakerCooldown', 60))
+            # global cap on simultaneous downloads and on total bandwidth, see SyncBudget below
+            self.budget = SyncBudget(self.constants.get('maxConnections', max(self.constants.get('workers', 1), 1)), self.constants.get('maxBandwidth'))
+        else:
+            self.session = shareWith.session
+            self.breaker = shareWith.breaker
+            self.budget = shareWith.budget
+
+
+    # creates the grib table if it doesn't exist, and walks an existing database forward one schema version at a time
+    # the version lives in sqlite's user_version pragma, so each step only ever runs once per database
+    #   v1: (model, cycle, member, fhour) is unique and fhour/member are stored as real integers...plus indexes for the purge/validTime lookups
+    #   v2: adds the region column, with (model, cycle, member, fhour, region) unique
+    #   v3: adds the arrays table, which records the decoded per-cycle array files written by ArrayStore.py
+    #   v4: adds the stats table, which records the cached ensemble statistics written by EnsCalculator.py
+    #   v5: creates the image table (if it isn't there already) with (model, cycle, member, fhour) unique
+    def __migrateSchema(self):
+        table = self.constants['archive']
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] >= 5:
+            return
+
+        with self.writeLock, self.conn:
+            # sqlite3 would run the CREATE TABLEs below in autocommit, so open the transaction by hand to make every step all-or-nothing
+            # (IMMEDIATE, and the version read again inside it, so two processes starting at once don't both migrate)
+            self.conn.execute('BEGIN IMMEDIATE')
+            version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+            if version < 1:
+                self.conn.execute('CREATE TABLE if not exists ' + table + ' (model TEXT, cycle TEXT, member INTEGER, fhour INTEGER, path TEXT, validTime TEXT)')
+                # rows without a full key can't go into the new table, and nothing could find them by key anyway, so they're dropped
+                dropped = self.conn.execute('SELECT COUNT(*) FROM ' + table + ' WHERE model IS NULL OR cycle IS NULL OR member IS NULL OR fhour IS NULL').fetchone()[0]
+                if dropped > 0:
+                    print('Dropping ' + str(dropped) + ' rows of ' + table + ' with no model, cycle, member or fhour while upgrading the schema')
+                self.conn.execute('DROP TABLE IF EXISTS ' + table + '_v1') # left over from an older, non-transactional attempt
+                self.conn.execute('CREATE TABLE ' + table + '_v1 (model TEXT NOT NULL, cycle TEXT NOT NULL, member INTEGER NOT NULL, fhour INTEGER NOT NULL, path TEXT, validTime TEXT, UNIQUE (model, cycle, member, fhour))')
+                # older databases could hold duplicate rows and zero-padded string fhours, so normalize them on the way across
+                self.conn.execute('INSERT OR REPLACE INTO ' + table + '_v1 SELECT model, cycle, CAST(member AS INTEGER), CAST(fhour AS INTEGER), path, validTime FROM ' + table
+                                  + ' WHERE model IS NOT NULL AND cycle IS NOT NULL AND member IS NOT NULL AND fhour IS NOT NULL')
+                self.conn.execute('DROP TABLE ' + table)
+                self.conn.execute('ALTER TABLE ' + table + '_v1 RENAME TO ' + table)
+                # the unique key already serves any (model, cycle) prefix lookup...deleteOldGribs() without a model filters on cycle alone, though
+                self.conn.execute('CREATE INDEX if not exists ' + table + '_cycle ON ' + table + ' (cycle)')
+                self.conn.execute('CREATE INDEX if not exists ' + table + '_validTime ON ' + table + ' (validTime)')
+                self.conn.execute('PRAGMA user_version = 1')
+            if version < 2:
+                # v2: a region column, so one download can be recorded alongside the regional subsets cut from it
+                # '' is the GRIB as downloaded, which is all any older database holds
+                self.conn.execute('DROP TABLE IF EXISTS ' + table + '_v2')
+                self.conn.execute('CREATE TABLE ' + table + '_v2 (model TEXT NOT NULL, cycle TEXT NOT NULL, member INTEGER NOT NULL, fhour INTEGER NOT NULL, path TEXT, validTime TEXT, region TEXT NOT NULL DEFAULT \'\', UNIQUE (model, cycle, member, fhour, region))')
+                self.conn.execute('INSERT INTO ' + table + '_v2 (model, cycle, member, fhour, path, validTime) SELECT model, cycle, member, fhour, path, validTime FROM ' + table)
+                self.conn.execute('DROP TABLE ' + table)
+                self.conn.execute('ALTER TABLE ' + table + '_v2 RENAME TO ' + table)
+                self.conn.execute('CREATE INDEX if not exists ' + table + '_cycle ON ' + table + ' (cycle)')
+                self.conn.execute('CREATE INDEX if not exists ' + table + '_validTime ON ' + table + ' (validTime)')
+                self.conn.execute('PRAGMA user_version = 2')
+            if version < 3:
+                arrays = self.constants.get('arrayArchive', 'arrays')
+                self.conn.execute('CREATE TABLE if not exists ' + arrays + ' (model TEXT NOT NULL, cycle TEXT NOT NULL, path TEXT, coordsPath TEXT, gribCount INTEGER, created TEXT, UNIQUE (model, cycle))')
+                self.conn.execute('PRAGMA user_version = 3')
+            if version < 4:
+                stats = self.constants.get('statsArchive', 'stats')
+                self.conn.execute('CREATE TABLE if not exists ' + stats + ' (model TEXT NOT NULL, cycle TEXT NOT NULL, fhour INTEGER NOT NULL, path TEXT, members INTEGER, created TEXT, UNIQUE (model, cycle, fhour))')
+                self.conn.execute('PRAGMA user_version = 4')
+            if version < 5:
+                images = self.constants.get('imgArchive', 'img')
+                self.conn.execute('CREATE TABLE if not exists ' + images + ' (model TEXT NOT NULL, cycle TEXT NOT NULL, member INTEGER NOT NULL, fhour INTEGER NOT NULL, path TEXT)')
+                # the unique key is what getMissingImages() anti-joins against
+                self.conn.execute('CREATE UNIQUE INDEX if not exists ' + images + '_key ON ' + images + ' (model, cycle, member, fhour)')
+                self.conn.execute('CREATE INDEX if not exists ' + images + '_cycle ON ' + images + ' (cycle)')
+                self.conn.execute('PRAGMA user_version = 5')
+
+    # (re)loads the in-memory inventory cache from the grib table in one pass
+    def loadInventory(self):
+        self.writer.flush()
+        self.inventory = {}
+        self.cycleCounts = {}
+        for model, cyclec, member, fHour, path in self.connections.reader().execute('SELECT model, cycle, member, fhour, path FROM ' + self.constants['archive'] + " WHERE region=''"):
+            self.__cacheAdd(model, cyclec, member, fHour, path)
+
+
+    # records a GRIB in the inventory cache, if there is one
+    def __cacheAdd(self, model, cyclec, member, fHour, path):
+        if self.inventory is None:
+            return
+        key = (model, cyclec, int(member), int(fHour))
+        if key not in self.inventory:
+            self.cycleCounts[(model, cyclec)] = self.cycleCounts.get((model, cyclec), 0) + 1
+        self.inventory[key] = path
+
+
+    # drops the given (model, cycle, member, fhour) keys from the inventory cache, if there is one
+    def __cacheRemove(self, keys):
+        if self.inventory is None:
+            return
+        for key in keys:
+            if key not in self.inventory:
+                continue
+            del self.inventory[key]
+            cycleKey = (key[0], key[1])
+            self.cycleCounts[cycleKey] = self.cycleCounts[cycleKey] - 1
+            if self.cycleCounts[cycleKey] == 0:
+                del self.cycleCounts[cycleKey]
+
 
     # returns a listing of all GRIB files currently available
-    # results returned as a list of tuples...where each tuple is a single record from the database, structured as (model, cycle, member, forecast-hour, file-path)
+    # results returned as a list of tuples...where each tuple is a single record from the database, structured as (model, cycle, member, forecast-hour, file-path, valid-time, region)
+    # region is '' for the GRIB as downloaded, or the name of a regional subset cut from it
     def listAllGribs(self):
         #db = self.constants['dbname']
         #table = self.constants['archive']
         #conn = sq.connect(db)
         #c = conn.cursor()
         sqlString = 'SELECT * FROM ' + self.constants['archive'] + ' ORDER BY cycle ASC' # build appropriate SQL query
-        self.curs.execute(sqlString)
-        result = self.curs.fetchall()
+        result = self.connections.reader().execute(sqlString).fetchall()
         if result is None:
             raise ValueError('There is no data in the specified database.')
         return result
 
 
-    # returns the record of the latest GRIB file stored in the database
+    # returns the (model, cycle) of the latest run stored in the database for each model
+    # optionally, for just one model
     def getLatestGrib(self, model=None):
+        table = self.constants['archive']
         if model is None:
-            sqlString = "SELECT DISTINCT grib.model as gm, grib.cycle as gc FROM grib INNER JOIN ( SELECT model, MAX(cycle) as cycle FROM grib) g ON gm=g.model AND gc=g.cycle" # build appropriate SQL query...does an inner join in order to get the most recent run for each model
+            # MAX() over the unique key's (model, cycle) prefix, so this is an index walk rather than a table scan
+            result = self.connections.reader().execute('SELECT model, MAX(cycle) FROM ' + table + ' GROUP BY model').fetchall()
         else:
-            sqlString = "SELECT DISTINCT grib.model as gm, grib.cycle as gc FROM grib INNER JOIN ( SELECT model, MAX(cycle) as cycle FROM grib WHERE model='" + model + "') g ON gm=g.model AND gc=g.cycle"
-        # if a model is specified, add another wrapper query to subset to just the requested model
-
-        self.curs.execute(sqlString)
-        result = self.curs.fetchall()
+            result = self.connections.reader().execute('SELECT model, MAX(cycle) FROM ' + table + ' WHERE model=? GROUP BY model', (model,)).fetchall()
         if result is None:
             raise ValueError('There is no data for the requested model present in the specified database.')
         return result
 
 
+    # returns the grib inventory as a pandas DataFrame, one row per GRIB, with member/fhour as integers and validTime as datetime64
+    # every filter is pushed down into the SQL query, so only the matching rows ever leave sqlite
+    #   model, cycle (YYYYMMDDHH), member: exact matches, or lists of values to match any of
+    #   fHours: a list of forecast hours
+    #   since/until: inclusive validTime bounds, as datetimes
+    #   region: '' (the default) for the GRIBs as downloaded, a region name for its subsets, or None for every row
+    def getInventoryFrame(self, model=None, cycle=None, member=None, fHours=None, since=None, until=None, region=''):
+        sqlString, params = self.__inventoryQuery('model, cycle, member, fhour, path, validTime, region', model, cycle, member, fHours, since, until, region)
+        self.writer.flush() # anything still queued has to be visible to the query
+        frame = pd.read_sql_query(sqlString + ' ORDER BY model, cycle, member, fhour', self.connections.reader(), params=params)
+        frame['member'] = frame['member'].astype(np.int16)
+        frame['fhour'] = frame['fhour'].astype(np.int16)
+        frame['validTime'] = pd.to_datetime(frame['validTime'])
+        return frame
+
+
+    # same filters as getInventoryFrame(), but returns just the typed numpy arrays a planner or plot needs:
+    # {'cycle': str array, 'member': int16, 'fhour': int16, 'validTime': datetime64[s]}
+    def getInventoryArrays(self, model=None, cycle=None, member=None, fHours=None, since=None, until=None, region=''):
+        frame = self.getInventoryFrame(model, cycle, member, fHours, since, until, region)
+        return {'cycle': frame['cycle'].to_numpy(dtype=str), 'member': frame['member'].to_numpy(), 'fhour': frame['fhour'].to_numpy(),
+                'validTime': frame['validTime'].to_numpy(dtype='datetime64[s]')}
+
+
+    # returns a member x forecast-hour DataFrame of booleans for one model cycle (YYYYMMDDHH), True where the GRIB is in the inventory
+    # rows/columns cover every member (-1 being the control) and forecast hour the config expects, so a missing file shows up as False
+    def getCompletenessMatrix(self, model, cyclec, region=''):
+        inc = self.models[model]['increment']
+        members = [-1] + list(range(1, self.models[model]['members'] + 1))
+        fHours = list(range(0, self.models[model]['fHours'] + inc, inc))
+
+        sqlString, params = self.__inventoryQuery('member, fhour', model, cyclec, None, None, None, None, region)
+        self.writer.flush() # anything still queued has to be visible to the query
+        present = np.array(self.connections.reader().execute(sqlString, params).fetchall(), dtype=np.int32).reshape(-1, 2)
+        matrix = np.zeros((len(members), len(fHours)), dtype=bool)
+        memberIndex = np.searchsorted(members, present[:, 0])
+        fHourIndex = np.searchsorted(fHours, present[:, 1])
+        # drop anything outside the configured members/forecast hours (e.g. left over from an older config)
+        valid = (memberIndex < len(members)) & (fHourIndex < len(fHours))
+        valid[valid] = (np.array(members)[memberIndex[valid]] == present[valid, 0]) & (np.array(fHours)[fHourIndex[valid]] == present[valid, 1])
+        matrix[memberIndex[valid], fHourIndex[valid]] = True
+        return pd.DataFrame(matrix, index=pd.Index(members, name='member'), columns=pd.Index(fHours, name='fhour'))
+
+
+    # builds the SELECT behind the columnar inventory methods, turning each filter that was given into a parameterized WHERE clause
+    # returns (sqlString, params)
+    def __inventoryQuery(self, columns, model, cycle, member, fHours, since, until, region):
+        clauses = []
+        params = []
+        for column, value in (('model', model), ('cycle', cycle), ('member', member), ('fhour', fHours), ('region', region)):
+            if value is None:
+                continue
+            # numpy scalars (e.g. from getInventoryArrays()) are unwrapped, since sqlite would bind them as BLOBs that match nothing
+            if isinstance(value, (list, tuple, set, np.ndarray)):
+                values = [v.item() if isinstance(v, np.generic) else v for v in value]
+                clauses.append(column + ' IN (' + ', '.join('?' * len(values)) + ')')
+                params.extend(values)
+            else:
+                clauses.append(column + '=?')
+                params.append(value.item() if isinstance(value, np.generic) else value)
+        # validTime is stored as 'YYYY-MM-DD HH:MM:SS' text, which sorts the same as the times themselves
+        if since is not None:
+            clauses.append('validTime >= ?')
+            params.append(since.strftime('%Y-%m-%d %H:%M:%S'))
+        if until is not None:
+            clauses.append('validTime <= ?')
+            params.append(until.strftime('%Y-%m-%d %H:%M:%S'))
+
+        sqlString = 'SELECT ' + columns + ' FROM ' + self.constants['archive']
+        if len(clauses) > 0:
+            sqlString = sqlString + ' WHERE ' + ' AND '.join(clauses)
+        return (sqlString, params)
+
+
     # returns the name of the requested model in NOMADS GRIB naming format (i.e. gec00, gep03, etc.)
     def __makeMemberString(self, model, member):
         # for both GEPS and GEFS, the control has a different syntax from each of the perturbation members
@@ -81,6 +298,21 @@ class DBManager:
         return model + '.' + cycle + '.' + str(hour).zfill(2) + '.f' + str(fHour).zfill(3) + '.' + memberString + '.grib'
 
 
+    # returns the named regions configured for a model, as name -> {'leftlon': ..., 'rightlon': ..., 'toplat': ..., 'bottomlat': ...}
+    # a model with no 'regions' in its config just has the one global box from the constants
+    def getRegions(self, model):
+        return self.models[model].get('regions') or {}
+
+
+    # returns the box to ask NOMADS for...the union of the model's regions if it has any, otherwise the global box from the constants
+    def __downloadBox(self, model):
+        regions = self.getRegions(model)
+        if len(regions) == 0:
+            return {key: self.constants[key] for key in ('leftlon', 'rightlon', 'toplat', 'bottomlat')}
+        return {'leftlon': min(r['leftlon'] for r in regions.values()), 'rightlon': max(r['rightlon'] for r in regions.values()),
+                'toplat': max(r['toplat'] for r in regions.values()), 'bottomlat': min(r['bottomlat'] for r in regions.values())}
+
+
     # given a model, run, forecast hour, and member number, generates the URL to access that GRIB file on NOMADS
     def __makeWebPath(self, model, cycle, hour, member, fHour):
         urlPatternBase = self.urlPatterns[model] # url patterns are stored in the class lookup table
@@ -89,15 +321,20 @@ class DBManager:
         #   modelUrlName = self.models[model]['controlName']
         #else:
         #   modelUrlName = self.models[model]['memberName'] + str(member).zfill(2)
-        urlPattern = urlPatternBase.format(model_name=modelUrlName, init_time=hour, fhour=fHour, leftlon=self.constants['leftlon'], rightlon=self.constants['rightlon'], toplat=self.constants['toplat'], bottomlat=self.constants['bottomlat'], yyyymmdd=cycle, ztime=hour) # done via built-in Pythonic string formatting/substitution
+        box = self.__downloadBox(model)
+        urlPattern = urlPatternBase.format(model_name=modelUrlName, init_time=hour, fhour=fHour, leftlon=box['leftlon'], rightlon=box['rightlon'], toplat=box['toplat'], bottomlat=box['bottomlat'], yyyymmdd=cycle, ztime=hour) # done via built-in Pythonic string formatting/substitution
         return urlPattern
 
 
     # given a model, run, forecase hour, and member number, generates the path to that hypothetical GRIB file
-    def __makeLocalPath(self, model, cycle, hour, member, fHour):
+    # regional subsets live in a subdirectory named for the region, inside the same cycle directory
+    def __makeLocalPath(self, model, cycle, hour, member, fHour, region=''):
         fileName = self.__gribName(model, cycle, hour, member, fHour)
         cyclec = cycle + str(hour).zfill(2)
-        localPath = model + '/' + cyclec + '/' + fileName
+        if region:
+            localPath = model + '/' + cyclec + '/' + region + '/' + fileName
+        else:
+            localPath = model + '/' + cyclec + '/' + fileName
         return self.constants['rootSrc'] + localPath
 
 
@@ -121,12 +358,22 @@ class DBManager:
     # returns path to file, if it exists, otherwise returns None
     def checkForFile(self, model, cycle, hour, member, fHour):
         cyclec = cycle + str(hour).zfill(2)
-        sqlString = "SELECT path FROM " + self.constants['archive'] + " WHERE model='" + model + "' AND cycle='" + cyclec + "' AND member = '" + str(member) + "' and fhour = '" + str(fHour).zfill(3) + "'" # build appropriate SQL string
 
-        self.curs.execute(sqlString)
-        result = self.curs.fetchall()
+        # with the inventory cache on, this is just a dict lookup
+        if self.inventory is not None:
+            path = self.inventory.get((model, cyclec, int(member), int(fHour)))
+            if path is not None:
+                return (True, path)
+            return (False, self.__makeLocalPath(model, cycle, hour, member, fHour))
+
+        # a GRIB that was just downloaded may still be waiting in the writer's batch, so it counts as present too
+        pending = self.writer.lookup((model, cyclec, member, fHour))
+        if pending is not None:
+            return (True, pending[4])
 
-        #print(result)
+        # parameterized, so sqlite reuses the one cached statement...and it's a single probe of the unique index
+        sqlString = "SELECT path FROM " + self.constants['archive'] + " WHERE model=? AND cycle=? AND member=? AND fhour=? AND region=''"
+        result = self.connections.reader().execute(sqlString, (model, cyclec, int(member), int(fHour))).fetchall()
 
         # if we get a list of len > 0 then we know the file exists, so just return the file path
         # otherwise, return False but also return the hypothetical path for IF the file did exist...so that this method can be flexible for creating a file that doesn't exist
@@ -136,79 +383,297 @@ class DBManager:
             return (False, self.__makeLocalPath(model, cycle, hour, member, fHour))
     
 
+    # returns (True, path) if the GRIB is already recorded in the database and present on disk, otherwise (False, path to download it to)
+    def __haveGrib(self, model, cycle, hour, member, fHour):
+        fileExists, filePath = self.checkForFile(model, cycle, hour, member, fHour)
+        return (fileExists and os.path.exists(filePath), filePath)
+
+
+    # pulls a single GRIB down from NOMADS and writes it to filePath, then cuts the model's regional subsets out of it
+    # returns the names of the regions that were cut successfully
+    # touches the network and the filesystem only, never the database, so it is safe to run from a worker thread
+    def __fetchGrib(self, model, cycle, hour, member, fHour, filePath):
+        gribUrl = self.__makeWebPath(model, cycle, hour, member, fHour) # create web path to download GRIB
+        os.makedirs(os.path.dirname(filePath), exist_ok=True) # os.makedirs ensures that the directory we need is created if it doesn't already exist
+
+        # download appropriate GRIB from NOMADS
+        # the response is streamed in chunks to a temporary file next to the final one, then fsync'd and renamed into place
+        # so memory use stays flat and nobody ever sees a half-written GRIB at filePath
+        tempPath = filePath + '.part'
+        chunkSize = self.constants.get('chunkSize', 65536)
+        labels = {'model': model, 'cycle': cycle + str(hour).zfill(2)}
+        result = 'error' # becomes the 'result' label on grib_downloads_total
+        self.breaker.wait() # if NOMADS has been failing, hold off until the breaker lets requests through again
+        self.budget.acquire() # and wait for a slot under the global concurrency limit
+        start = time.perf_counter()
+        try:
+            with self.session.open(gribUrl) as mike:
+                with open(tempPath, 'wb') as gribby:
+                    chunk = mike.read(chunkSize)
+                    self.metrics.observe('grib_ttfb_seconds', time.perf_counter() - start, **labels) # time to first byte
+                    while chunk:
+                        gribby.write(chunk)
+                        self.metrics.increment('grib_download_bytes_total', len(chunk), **labels)
+                        self.budget.consume(len(chunk)) # sleeps as needed to stay under the bandwidth limit
+                        chunk = mike.read(chunkSize)
+                    gribby.flush()
+                    os.fsync(gribby.fileno())
+            os.replace(tempPath, filePath) # atomic on POSIX, so the GRIB either fully exists or doesn't exist at all
+            self.breaker.record(True)
+            result = 'ok'
+        except HTTPError as hte:
+            if hte.code >= 500:
+                self.breaker.record(False)
+                result = 'server_error'
+                raise GRIBServerError('NOMADS returned HTTP ' + str(hte.code) + ' for ' + self.__gribName(model, cycle, hour, member, fHour), filePath)
+            self.breaker.record(True) # NOMADS answered, the file just isn't there (yet)
+            result = 'not_found'
+            raise ValueError('Specified GRIB (' + self.__gribName(model, cycle, hour, member, fHour) + ') not available for download.')
+        except URLError as urle:
+            self.breaker.record(False)
+            if isinstance(urle.reason, timeout):
+                result = 'timeout'
+                raise GRIBTimeoutError("NOMADS connection timed out for " + self.__gribName(model, cycle, hour, member, fHour), filePath)
+            else:
+                raise
+        except timeout as ste:
+            self.breaker.record(False)
+            result = 'timeout'
+            raise GRIBTimeoutError("There was a connection error with " + self.__gribName(model, cycle, hour, member, fHour), filePath)
+        finally:
+            self.budget.release()
+            self.metrics.observe('grib_download_seconds', time.perf_counter() - start, **labels)
+            self.metrics.increment('grib_downloads_total', result=result, **labels)
+            # if anything went wrong midway, don't leave the partial download lying around
+            if os.path.exists(tempPath):
+                try:
+                    os.remove(tempPath)
+                except OSError:
+                    pass
+
+        return self.__cutRegions(model, cycle, hour, member, fHour, filePath)
+
+
+    # cuts each of the model's regions out of a downloaded GRIB with wgrib2 -small_grib (the 'wgrib2' constant says where it lives)
+    # each subset is written to a temp file and renamed into place, same as downloads
+    # regions limits it to those names, e.g. to re-cut just the subsets missing from a GRIB that's already on disk
+    # returns the names of the regions that were cut...a region that fails is reported and skipped, the download itself still counts
+    def __cutRegions(self, model, cycle, hour, member, fHour, filePath, regions=None):
+        cut = []
+        for region, box in self.getRegions(model).items():
+            if regions is not None and region not in regions:
+                continue
+            regionPath = self.__makeLocalPath(model, cycle, hour, member, fHour, region)
+            os.makedirs(os.path.dirname(regionPath), exist_ok=True)
+            tempPath = regionPath + '.part'
+            try:
+                subprocess.run([self.constants.get('wgrib2', 'wgrib2'), filePath, '-small_grib', str(box['leftlon']) + ':' + str(box['rightlon']), str(box['bottomlat']) + ':' + str(box['toplat']), tempPath],
+                               check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                os.replace(tempPath, regionPath)
+                cut.append(region)
+            except (OSError, subprocess.CalledProcessError) as e:
+                print('Could not cut region ' + region + ' from ' + self.__gribName(model, cycle, hour, member, fHour) + ': ' + str(e))
+                if os.path.exists(tempPath):
+                    os.remove(tempPath)
+        return cut
+
+
     # returns path to appropriate GRIB2 file which was just created
     # raises ValueError when GRIB isn't available from NOMADS
     def downloadGrib(self, model, cycle, hour, member, fHour):
-        #filePath = self.makeLocalPath(model, run, fHour, member) # create file path based on input vars
-        fileExists, filePath = self.checkForFile(model, cycle, hour, member, fHour) # check if that path exists already
+        fileExists, filePath = self.__haveGrib(model, cycle, hour, member, fHour) # check if that path exists already
         # if it exists, just return the path...otherwise download it and then return the path
-        if fileExists and os.path.exists(filePath[0]):
+        if fileExists:
+            # regional subsets that failed last time, or regions added to the config since, are cut from the GRIB already on disk
+            missingRegions = self.__missingRegions(model, cycle, hour, member, fHour)
+            if len(missingRegions) > 0:
+                self.__recordRegions(model, cycle, hour, member, fHour, self.__cutRegions(model, cycle, hour, member, fHour, filePath, missingRegions))
             return filePath
         else:
-            gribUrl = self.__makeWebPath(model, cycle, hour, member, fHour) # create web path to download GRIB
-            #print(fileExists)
-            #print(filePath)
-            os.makedirs(os.path.dirname(filePath), exist_ok=True) # os.makedirs ensures that the directory we need is created if it doesn't already exist
-
-            # download appropriate GRIB from NOMADS
-            try: 
-                with url.urlopen(gribUrl, None, 30) as mike:
-                    with open(filePath, 'wb') as gribby:
-                        gribby.write(mike.read()) # first, write the GRIB file to disk
-                        self.__createNewGrib(model, cycle, hour, member, fHour) # second, create record of the GRIB we just created in the database
-            except HTTPError as hte:
-                raise ValueError('Specified GRIB (' + self.__gribName(model, cycle, hour, member, fHour) + ') not available for download.')
-                #return None
-                #print(filePath)
-            except URLError as urle:
-                if isinstance(urle.reason, timeout):
-                    raise GRIBTimeoutException("NOMADS connection timed out for " + self.__gribName(model, cycle, hour, member, fHour), filePath)
-                else:
-                    raise
-            except timeout as ste:
-                raise GRIBTimeoutError("There was a connection error with " + self.__gribName(model, cycle, hour, member, fHour), filePath)
-
+            regions = self.__fetchGrib(model, cycle, hour, member, fHour, filePath) # first, write the GRIB file (and its regional subsets) to disk
+            self.__createNewGrib(model, cycle, hour, member, fHour, regions) # second, create record of the GRIB we just created in the database
             return filePath
 
 
-    # downloads all forecast hours for a certain model and member
-    def downloadModel(self, model, cycle, hour, member=None):
+    # returns the (member, forecast hour) pairs making up a model run, in download order
+    # control first, then each perturbation member, for every forecast hour
+    def __modelFiles(self, model, member=None):
         maxFHour = self.models[model]['fHours'] # set up loop to stop at the final forecast hour specified in configuration
         inc = self.models[model]['increment'] # set up loop to increment by specified number of forecast hours in configuration
+        if member is None:
+            members = [-1] + list(range(1, self.models[model]['members']+1)) # control member, then every perturbation member
+        else:
+            members = [member]
+        return [(j, i) for i in range(0, maxFHour+inc, inc) for j in members]
+
+
+    # returns, for each of the given model cycles (YYYYMMDDHH), the (member, forecast hour) pairs that aren't in the inventory yet
+    # result is a dict of cycle -> sorted list of missing pairs, which is empty for a complete cycle
+    # without the inventory cache this is a single EXCEPT query of the expected files against the grib table
+    def getMissingGribs(self, model, cycles):
+        expected = self.__modelFiles(model)
+        missing = {cyclec: [] for cyclec in cycles}
+
+        regions = [''] + sorted(self.getRegions(model))
+
+        # the inventory cache only holds the GRIBs as downloaded, so it can only answer for models without regions
+        if self.inventory is not None and len(regions) == 1:
+            for cyclec in cycles:
+                missing[cyclec] = sorted(f for f in expected if (model, cyclec, f[0], f[1]) not in self.inventory)
+            return missing
+
+        self.writer.flush() # anything still queued has to be visible to the query
+        # read-only connections can still have TEMP tables, and since readers are per-thread, so is this one
+        # a file counts as missing if the GRIB itself or any of the model's regional subsets isn't recorded...downloadModel() then re-cuts
+        # the subsets from the GRIB on disk rather than downloading it again
+        reader = self.connections.reader()
+        reader.execute('DROP TABLE IF EXISTS temp.expected') # older versions of this table had no region column
+        reader.execute('CREATE TEMP TABLE expected (cycle TEXT, member INTEGER, fhour INTEGER, region TEXT)')
+        reader.executemany('INSERT INTO temp.expected VALUES (?, ?, ?, ?)', [(cyclec, j, i, region) for cyclec in cycles for j, i in expected for region in regions])
+        sqlString = 'SELECT DISTINCT cycle, member, fhour FROM (SELECT cycle, member, fhour, region FROM temp.expected EXCEPT SELECT cycle, member, fhour, region FROM ' + self.constants['archive'] + ' WHERE model=?)'
+        for cyclec, j, i in reader.execute(sqlString, (model,)).fetchall():
+            missing[cyclec].append((j, i))
+        reader.commit() # temp table writes still open an implicit transaction, so close it
+
+        for cyclec in missing:
+            missing[cyclec].sort()
+        return missing
+
+
+    # summarizes how complete each of the given model cycles is locally
+    # returns a dict of cycle -> {'expected': n, 'present': n, 'missing': n, 'complete': bool}
+    def getCompletenessReport(self, model, cycles):
+        expected = len(self.__modelFiles(model))
+        report = {}
+        for cyclec, files in self.getMissingGribs(model, cycles).items():
+            report[cyclec] = {'expected': expected, 'present': expected - len(files), 'missing': len(files), 'complete': len(files) == 0}
+        return report
+
+
+    # downloads all forecast hours for a certain model and member (or every member, if none is specified)
+    # alternatively, files can be an explicit list of (member, fHour) pairs to download, e.g. from getMissingGribs()
+    # workers sets how many GRIBs are in flight at once...defaults to the 'workers' constant in the config, or 1 (one at a time) if that's missing
+    # files that time out or get a 5xx from NOMADS go on a retry queue, which is worked through after the main pass with exponential
+    # backoff plus jitter, up to the 'retries' constant (default 3) extra attempts per file
+    # returns a summary of the form {'succeeded': [(member, fHour), ...], 'failed': [(member, fHour), ...], 'retried': [(member, fHour), ...]}
+    def downloadModel(self, model, cycle, hour, member=None, workers=None, files=None):
+        if workers is None:
+            workers = self.constants.get('workers', 1)
+        if files is None:
+            files = self.__modelFiles(model, member)
+        summary = {'succeeded': [], 'failed': [], 'retried': []}
+        maxRetries = self.constants.get('retries', 3)
+        retryBase = self.constants.get('retryBase', 5.0)
 
-        # loop through every forecast hour 
-        for i in range(0, maxFHour+inc, inc):
-            # if no member is specified, we're looping through EVERY member of the ensemble...
-            if member is None:
-                # download control member
+        try:
+            # main pass
+            retryQueue = [] # heap of (time the file may be retried, attempt number, member, fHour)
+            for j, i in self.__downloadPass(model, cycle, hour, files, workers, summary):
+                if maxRetries > 0:
+                    heapq.heappush(retryQueue, (time.monotonic() + self.__backoff(retryBase, 1), 1, j, i))
+                else:
+                    summary['failed'].append((j, i))
+
+            # retry queue...each round takes every file that's due, and anything that fails again goes back on with a longer delay
+            while len(retryQueue) > 0:
+                wait = retryQueue[0][0] - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                due = []
+                while len(retryQueue) > 0 and retryQueue[0][0] <= time.monotonic():
+                    due.append(heapq.heappop(retryQueue))
+                attempts = {(j, i): attempt for (_, attempt, j, i) in due}
+                summary['retried'].extend(f for f in attempts if f not in summary['retried'])
+
+                for j, i in self.__downloadPass(model, cycle, hour, list(attempts.keys()), workers, summary):
+                    attempt = attempts[(j, i)] + 1
+                    if attempt <= maxRetries:
+                        heapq.heappush(retryQueue, (time.monotonic() + self.__backoff(retryBase, attempt), attempt, j, i))
+                    else:
+                        summary['failed'].append((j, i)) # out of retries
+        finally:
+            self.writer.flush() # commit whatever is left of the last batch, even if something went wrong along the way
+        return summary
+
+
+    # returns how long to wait before the given retry attempt...exponential in the attempt number, with 'full jitter'
+    # so that a batch of files which failed together doesn't all come back at the same moment
+    def __backoff(self, base, attempt):
+        return random.uniform(0, base * 2 ** (attempt - 1))
+
+
+    # downloads the given (member, fHour) pairs once, recording successes and permanent failures in summary
+    # returns the pairs that failed in a way worth retrying (timeouts and 5xx errors)
+    def __downloadPass(self, model, cycle, hour, files, workers, summary):
+        retry = []
+
+        # serial mode...one GRIB after another
+        if workers <= 1:
+            for j, i in files:
                 try:
-                    self.downloadGrib(model, cycle, hour, -1, i) 
+                    self.downloadGrib(model, cycle, hour, j, i)
+                    missingRegions = self.__missingRegions(model, cycle, hour, j, i)
+                    if len(missingRegions) > 0: # the GRIB is in, but it's not finished until every region is cut from it
+                        summary['failed'].append((j, i))
+                    else:
+                        summary['succeeded'].append((j, i))
                 except ValueError as v:
                     print(str(v))
-                except GRIBTimeoutError as gte: # if the connection times out, just print the filepath of the missing GRIB
+                    summary['failed'].append((j, i))
+                except GRIBTimeoutError as gte: # if the connection times out, print the filepath of the missing GRIB and queue it up to try again
                     print(str(gte))
+                    retry.append((j, i))
+                except (OSError, HTTPException) as e: # connection refused, DNS failure, a dropped stream, a full disk...this file fails, the rest carry on
+                    print('Could not download ' + self.__gribName(model, cycle, hour, j, i) + ': ' + str(e))
+                    summary['failed'].append((j, i))
+            return retry
+
+        # parallel mode...the network half of each download runs on the pool, but every database call stays on this thread
+        # since the sqlite connection can't be shared across threads
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            inFlight = {}
+            allRegions = sorted(self.getRegions(model))
+            for j, i in files:
+                fileExists, filePath = self.__haveGrib(model, cycle, hour, j, i)
+                if not fileExists:
+                    inFlight[pool.submit(self.__fetchGrib, model, cycle, hour, j, i, filePath)] = (j, i, allRegions, False)
+                    continue
+                # already on disk...just cut whatever regional subsets it's missing (failed last time, or added to the config since)
+                missingRegions = self.__missingRegions(model, cycle, hour, j, i)
+                if len(missingRegions) > 0:
+                    inFlight[pool.submit(self.__cutRegions, model, cycle, hour, j, i, filePath, missingRegions)] = (j, i, missingRegions, True)
+                else:
+                    summary['succeeded'].append((j, i))
 
-                # loop through every member if no member is selected
-                for j in range(1,self.models[model]['members']+1):
-                    #print(j)
-                    try:
-                        self.downloadGrib(model, cycle, hour, j, i)
-                    except ValueError as v:
-                        print(str(v))
-                    except GRIBTimeoutError as gte: # if the connection times out, just print the filepath of the missing GRIB
-                        print(str(gte))
-            else:
-                try: 
-                    self.downloadGrib(model, cycle, hour, member, i) # otherwise just download the requested member
+            for future in as_completed(inFlight):
+                j, i, wanted, recut = inFlight[future]
+                try:
+                    regions = future.result()
+                    if recut:
+                        self.__recordRegions(model, cycle, hour, j, i, regions)
+                    else:
+                        self.__createNewGrib(model, cycle, hour, j, i, regions)
+                    # the GRIB is in either way, but it's not finished (and getMissingGribs() keeps listing it) until every region is cut
+                    if len(regions) < len(wanted):
+                        summary['failed'].append((j, i))
+                    else:
+                        summary['succeeded'].append((j, i))
                 except ValueError as v:
                     print(str(v))
+                    summary['failed'].append((j, i))
                 except GRIBTimeoutError as gte:
                     print(str(gte))
+                    retry.append((j, i))
+                except (OSError, HTTPException) as e: # as above...and the downloads that did finish still get recorded
+                    print('Could not download ' + self.__gribName(model, cycle, hour, j, i) + ': ' + str(e))
+                    summary['failed'].append((j, i))
+        return retry
 
 
     # creates a new entry in grib database with details of a particular GRIB file
     # 'private' method which should only be run within downloadGrib(), after a GRIB has been successfully downloaded, to preserve db
-    def __createNewGrib(self, model, cycle, hour, member, fHour):
+    # regions lists the regional subsets that were cut from it, each of which gets its own row too
+    def __createNewGrib(self, model, cycle, hour, member, fHour, regions=()):
         filePath = self.__makeLocalPath(model, cycle, hour, member, fHour) # start by getting the path to the file
 
         #db = self.constants['dbname']
@@ -219,67 +684,432 @@ class DBManager:
         validTime = self.__calculateValidTime(cycle, hour, fHour)
 
         cyclec = cycle + str(hour).zfill(2)
-        modelTuple = [(model, cyclec, member, fHour, filePath, validTime)]
-        sqlString = 'INSERT INTO ' + self.constants['archive'] + ' VALUES (?, ?, ?, ?, ?, ?)'
+        gribRecord = (model, cyclec, member, fHour, filePath, validTime, '')
+        sqlString = 'INSERT OR REPLACE INTO ' + self.constants['archive'] + ' (model, cycle, member, fhour, path, validTime, region) VALUES (?, ?, ?, ?, ?, ?, ?)'
+
+        # the row is queued rather than committed right away...the writer executemany()s the whole batch in a single transaction
+        # once it's big enough or old enough, or when downloadModel() finishes
+        self.writer.queue(sqlString, gribRecord, (model, cyclec, member, fHour))
+        # a new member means any ensemble statistics cached for this forecast hour are out of date
+        # queued once per batch rather than after every row, so the inserts still go out as one executemany()
+        self.writer.queueOnce('DELETE FROM ' + self.constants.get('statsArchive', 'stats') + ' WHERE model=? AND cycle=? AND fhour=?', (model, cyclec, fHour))
+        self.__recordRegions(model, cycle, hour, member, fHour, regions)
+        self.__cacheAdd(model, cyclec, member, fHour, filePath)
+        self.metrics.increment('grib_rows_queued_total', model=model, cycle=cyclec)
+
+
+    # queues rows for regional subsets cut from a GRIB
+    def __recordRegions(self, model, cycle, hour, member, fHour, regions):
+        cyclec = cycle + str(hour).zfill(2)
+        validTime = self.__calculateValidTime(cycle, hour, fHour)
+        sqlString = 'INSERT OR REPLACE INTO ' + self.constants['archive'] + ' (model, cycle, member, fhour, path, validTime, region) VALUES (?, ?, ?, ?, ?, ?, ?)'
+        for region in regions:
+            self.writer.queue(sqlString, (model, cyclec, member, fHour, self.__makeLocalPath(model, cycle, hour, member, fHour, region), validTime, region), (model, cyclec, member, fHour, region))
+
 
-        # uses SQLite's executemany() function, which I have only recently discovered but which I understand as follows
-        # replace each individual field's value with a ? in records denoted by ( ... ) in the SQL command
-        # pass in an array of tuples, with each tuple being one of the records to insert, and each value in a tuple being a field value in the specified record
-        # even if these details aren't 100% accurate...I mean it works, so like...
-        self.curs.executemany(sqlString, modelTuple)
-        self.conn.commit()
+    # returns the names of the model's regions with no recorded subset of the given GRIB (queued rows count as recorded)
+    def __missingRegions(self, model, cycle, hour, member, fHour):
+        regions = self.getRegions(model)
+        if len(regions) == 0:
+            return []
+        cyclec = cycle + str(hour).zfill(2)
+        sqlString = 'SELECT region FROM ' + self.constants['archive'] + ' WHERE model=? AND cycle=? AND member=? AND fhour=?'
+        present = set(row[0] for row in self.connections.reader().execute(sqlString, (model, cyclec, int(member), int(fHour))).fetchall())
+        return [region for region in sorted(regions) if region not in present and self.writer.lookup((model, cyclec, member, fHour, region)) is None]
 
 
     # deletes all GRIB files with cycle ID older than a certain date
     # optionally, do this only for a specified model
-    # notably enough  
-    def deleteOldGribs(self, olderThan, model=None):
-        sqlString = "SELECT path FROM " + self.constants['archive'] + " WHERE cycle < " + olderThan
+    # works a whole cycle at a time...every expired model/YYYYMMDDHH/ directory under rootSrc is removed outright (including ones the
+    # database has already forgotten about), with the models handled in parallel unless parallel=False, and then all the matching
+    # rows are deleted in a single transaction
+    # images rendered from those GRIBs (model/YYYYMMDDHH/ under imgSrc) go in the same pass, and their rows in the same transaction
+    # returns a summary of the form {'cycles': n, 'rows': n, 'images': n, 'files': n, 'bytes': n}, where cycles counts GRIB and image
+    # directories alike
+    def deleteOldGribs(self, olderThan, model=None, parallel=True):
+        start = time.perf_counter()
+        olderThan = str(olderThan)
+        self.writer.flush() # so the counts below include anything still queued
+        models = list(self.models.keys()) if model is None else [model]
+
+        # which expired cycles the database knows about, and how many rows each one has
+        whereString = " WHERE cycle < ?"
+        params = (olderThan,)
         if model is not None:
-            sqlString = sqlString + " AND model='" + model + "'"
-        self.curs.execute(sqlString)
-        result = self.curs.fetchall()
-        
-        if result is None:
-            return
+            whereString = whereString + " AND model=?"
+            params = params + (model,)
+        expired = self.connections.reader().execute("SELECT model, cycle, COUNT(*) FROM " + self.constants['archive'] + whereString + " GROUP BY model, cycle", params).fetchall()
+        images = self.connections.reader().execute("SELECT COUNT(*) FROM " + self.constants.get('imgArchive', 'img') + whereString, params).fetchone()[0]
+        summary = {'cycles': 0, 'rows': sum(row[2] for row in expired), 'images': images, 'files': 0, 'bytes': 0}
+
+        # clear out the directories...one job per model
+        cycleDirs = {m: set() for m in models}
+        for m, cyclec, count in expired:
+            cycleDirs.setdefault(m, set()).add(os.path.join(self.constants['rootSrc'], m, cyclec))
+        for m in list(cycleDirs):
+            cycleDirs[m].update(self.__cycleDirs(self.constants['rootSrc'], m, olderThan))
+            cycleDirs[m].update(self.__cycleDirs(self.constants.get('imgSrc'), m, olderThan))
+
+        if parallel and len(cycleDirs) > 1:
+            with ThreadPoolExecutor(max_workers=len(cycleDirs)) as pool:
+                results = list(pool.map(self.__purgeCycleDirs, cycleDirs.values()))
         else:
-            for thing in result:
-                try:
-                    os.remove(thing[0])
-                except OSError:
-                    pass
-
-        sqlString = "DELETE FROM " + self.constants['archive'] + " WHERE cycle < " + olderThan
+            results = [self.__purgeCycleDirs(dirs) for dirs in cycleDirs.values()]
+        for cycles, files, size in results:
+            summary['cycles'] = summary['cycles'] + cycles
+            summary['files'] = summary['files'] + files
+            summary['bytes'] = summary['bytes'] + size
+
+        self.writer.queue("DELETE FROM " + self.constants['archive'] + whereString, params)
+        self.writer.queue("DELETE FROM " + self.constants.get('arrayArchive', 'arrays') + whereString, params) # their array files lived in the cycle directories too
+        self.writer.queue("DELETE FROM " + self.constants.get('statsArchive', 'stats') + whereString, params) # and so did their statistics
+        self.writer.queue("DELETE FROM " + self.constants.get('imgArchive', 'img') + whereString, params) # and the images rendered from them
+        self.writer.flush() # the deletes go out in the same transaction as anything still pending
+        if self.inventory is not None:
+            self.__cacheRemove([key for key in self.inventory if key[1] < olderThan and (model is None or key[0] == model)])
+        # purged cycles won't be asked about again, so their probe results can go too
+        for key in [k for k in self.probeCache if k[1] < olderThan and (model is None or k[0] == model)]:
+            del self.probeCache[key]
+
+        self.metrics.observe('purge_seconds', time.perf_counter() - start, model=model)
+        self.metrics.increment('purge_cycles_total', summary['cycles'], model=model)
+        self.metrics.increment('purge_files_total', summary['files'], model=model)
+        self.metrics.increment('purge_bytes_total', summary['bytes'], model=model)
+        return summary
+
+
+    # returns every model/YYYYMMDDHH/ directory under root (rootSrc or imgSrc), or just the ones older than olderThan, whether or not the
+    # database knows about them
+    def __cycleDirs(self, root, model, olderThan=None):
+        found = set()
+        if root is None:
+            return found
+        modelDir = os.path.join(root, model)
+        if os.path.isdir(modelDir):
+            with os.scandir(modelDir) as entries:
+                for entry in entries:
+                    if entry.is_dir() and (olderThan is None or entry.name < olderThan):
+                        found.add(entry.path)
+        return found
+
+
+    # removes a set of cycle directories outright
+    # returns (directories removed, files removed, bytes freed)
+    def __purgeCycleDirs(self, cycleDirs):
+        cycles, files, size = 0, 0, 0
+        for cycleDir in cycleDirs:
+            if not os.path.isdir(cycleDir):
+                continue
+            # tally up what's in there first (regional subsets are one level down), then drop the whole tree in one go
+            toScan = [cycleDir]
+            while len(toScan) > 0:
+                with os.scandir(toScan.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            toScan.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            files = files + 1
+                            size = size + entry.stat(follow_symlinks=False).st_size
+            errors = []
+            shutil.rmtree(cycleDir, onerror=lambda function, path, excinfo: errors.append((path, excinfo[1])))
+            if len(errors) > 0:
+                # carry on with the rest, but say so...anything left behind is picked up by reconcileArchive() or the next purge
+                print('Could not remove ' + str(len(errors)) + ' entries under ' + cycleDir + ', e.g. ' + errors[0][0] + ': ' + str(errors[0][1]))
+                self.metrics.increment('purge_errors_total', len(errors))
+            cycles = cycles + 1
+        return (cycles, files, size)
+
+
+    # checks the archive under rootSrc against the grib table, optionally for just one model
+    # every cycle directory (on disk or in the database) is walked with os.scandir, in parallel over 'workers' threads, and each GRIB's
+    # message framing is checked (see __checkGrib())...the results are compared with the whole inventory, read in one query, to find:
+    #   missing: rows whose file isn't on disk
+    #   corrupt: empty or truncated GRIBs, as (path, reason)
+    #   orphans: intact GRIBs the database doesn't know about
+    #   partials: temp files left behind by aborted downloads/writes...only ones untouched for longer than 'partialAge' seconds (default
+    #   the download timeout plus 15 minutes), so the temp files of a download or array build that's still running are left alone
+    # with repair=True, corrupt files, partials and orphans that aren't where this manager would have put them are deleted, orphans that
+    # are (e.g. a download whose row never got committed) are adopted back into the table, and every row change goes out in a single
+    # transaction...ensemble statistics and array files for the cycles touched are dropped so they get rebuilt
+    # returns a summary of the form {'scanned': n, 'missing': [...], 'corrupt': [...], 'orphans': [...], 'partials': [...],
+    # 'adopted': [...], 'removed': [...], 'errors': [(path, message), ...], 'seconds': s}
+    def reconcileArchive(self, model=None, repair=False, workers=None):
+        start = time.perf_counter()
+        if workers is None:
+            workers = self.constants.get('workers', 1)
+        self.writer.flush() # the inventory has to include anything still queued
+        rootSrc = self.constants['rootSrc']
+        models = list(self.models.keys()) if model is None else [model]
+
+        # the whole inventory, in one go
+        sqlString = 'SELECT model, cycle, member, fhour, region, path FROM ' + self.constants['archive']
+        params = ()
         if model is not None:
-            sqlString = sqlString + " AND model='" + model + "'"
-        self.curs.execute(sqlString)
-        self.conn.commit()
-
-
-    # deletes a single specified GRIB file
+            sqlString = sqlString + ' WHERE model=?'
+            params = (model,)
+        recorded = {os.path.normpath(row[5]): row[0:5] for row in self.connections.reader().execute(sqlString, params).fetchall()}
+
+        # every cycle directory on disk or in the database
+        cycleDirs = set(os.path.join(rootSrc, key[0], key[1]) for key in recorded.values())
+        for m in models:
+            cycleDirs.update(self.__cycleDirs(rootSrc, m))
+        if workers > 1 and len(cycleDirs) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(self.__scanCycleDir, sorted(cycleDirs)))
+        else:
+            results = [self.__scanCycleDir(cycleDir) for cycleDir in sorted(cycleDirs)]
+
+        onDisk = {}
+        summary = {'scanned': 0, 'missing': [], 'corrupt': [], 'orphans': [], 'partials': [], 'adopted': [], 'removed': [], 'errors': [], 'seconds': 0}
+        cutoff = time.time() - self.constants.get('partialAge', self.constants.get('timeout', 30) + 900)
+        for gribs, partials in results:
+            for path, problem in gribs:
+                onDisk[os.path.normpath(path)] = problem
+            summary['partials'].extend(path for path, modified in partials if modified < cutoff)
+        summary['scanned'] = len(onDisk)
+        summary['missing'] = sorted(path for path in recorded if path not in onDisk)
+        summary['corrupt'] = sorted((path, problem) for path, problem in onDisk.items() if problem is not None)
+        summary['orphans'] = sorted(path for path, problem in onDisk.items() if problem is None and path not in recorded)
+
+        if repair:
+            self.__repairArchive(recorded, summary)
+
+        summary['seconds'] = time.perf_counter() - start
+        self.metrics.observe('reconcile_seconds', summary['seconds'], model=model)
+        for key in ('missing', 'corrupt', 'orphans', 'partials'):
+            self.metrics.increment('reconcile_' + key + '_total', len(summary[key]), model=model)
+        return summary
+
+
+    # fixes up what reconcileArchive() found: files first, then every row change in one transaction
+    def __repairArchive(self, recorded, summary):
+        toRemove = [path for path, problem in summary['corrupt']] + summary['partials']
+        deletes = [recorded[path] for path in summary['missing']] + [recorded[path] for path, problem in summary['corrupt'] if path in recorded]
+        inserts = []
+        expected = {} # (model, cycle, region) -> {path: (member, fHour)}, built only for directories with orphans in them
+        for path in summary['orphans']:
+            parts = os.path.relpath(path, self.constants['rootSrc']).split(os.sep)
+            if len(parts) in (3, 4) and parts[0] in self.models and len(parts[1]) == 10 and parts[1].isdigit():
+                m, cyclec = parts[0], parts[1]
+                region = parts[2] if len(parts) == 4 else ''
+                if (region == '' or region in self.getRegions(m)) and (m, cyclec, region) not in expected:
+                    expected[(m, cyclec, region)] = {os.path.normpath(self.__makeLocalPath(m, cyclec[0:8], int(cyclec[8:]), j, i, region)): (j, i) for j, i in self.__modelFiles(m)}
+                files = expected.get((m, cyclec, region), {})
+                if path in files:
+                    member, fHour = files[path]
+                    inserts.append((m, cyclec, member, fHour, path, self.__calculateValidTime(cyclec[0:8], int(cyclec[8:]), fHour), region))
+                    continue
+            toRemove.append(path)
+
+        for path in toRemove:
+            try:
+                os.remove(path)
+                summary['removed'].append(path)
+            except OSError as e:
+                summary['errors'].append((path, str(e)))
+
+        # anything whose member count just changed needs its statistics and array file rebuilt
+        touched = set((key[0], key[1], key[3]) for key in deletes) | set((row[0], row[1], row[3]) for row in inserts)
+        table = self.constants['archive']
+        with self.writer.lock, self.conn: # commits on success, rolls the whole lot back on failure
+            self.conn.executemany('DELETE FROM ' + table + ' WHERE model=? AND cycle=? AND member=? AND fhour=? AND region=?', deletes)
+            self.conn.executemany('INSERT OR REPLACE INTO ' + table + ' (model, cycle, member, fhour, path, validTime, region) VALUES (?, ?, ?, ?, ?, ?, ?)', inserts)
+            self.conn.executemany('DELETE FROM ' + self.constants.get('statsArchive', 'stats') + ' WHERE model=? AND cycle=? AND fhour=?', sorted(touched))
+            self.conn.executemany('DELETE FROM ' + self.constants.get('arrayArchive', 'arrays') + ' WHERE model=? AND cycle=?', sorted(set((m, c) for m, c, f in touched)))
+        summary['adopted'] = [row[4] for row in inserts]
+
+        self.__cacheRemove([(m, cyclec, int(member), int(fHour)) for m, cyclec, member, fHour, region in deletes if region == ''])
+        for m, cyclec, member, fHour, path, validTime, region in inserts:
+            if region == '':
+                self.__cacheAdd(m, cyclec, member, fHour, path)
+
+
+    # walks one cycle directory (and the region directories inside it)
+    # returns ([(GRIB path, problem or None), ...], [(temp file path, mtime), ...])...anything else, like array and statistics files, is ignored
+    # touches the filesystem only, so it's safe to run from a worker thread
+    def __scanCycleDir(self, cycleDir):
+        gribs, partials = [], []
+        if not os.path.isdir(cycleDir):
+            return (gribs, partials)
+        toScan = [cycleDir]
+        while len(toScan) > 0:
+            with os.scandir(toScan.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        toScan.append(entry.path)
+                    elif entry.name.endswith('.part') or '.part.' in entry.name:
+                        try:
+                            partials.append((entry.path, entry.stat(follow_symlinks=False).st_mtime))
+                        except FileNotFoundError:
+                            pass # renamed into place while we were looking
+                    elif entry.name.endswith('.grib'):
+                        try:
+                            gribs.append((entry.path, self.__checkGrib(entry.path, entry.stat(follow_symlinks=False).st_size)))
+                        except FileNotFoundError:
+                            pass # purged or replaced while we were looking, so there's nothing to judge
+        return (gribs, partials)
+
+
+    # checks that a file is a complete run of GRIB messages by hopping from header to header: each message has to start with 'GRIB',
+    # end with '7777' right where its length says it does, and the last one has to end right at the end of the file
+    # only a few bytes per message are read, so this stays cheap however big the GRIB is
+    # returns None if the file looks intact, otherwise 'empty', 'not a GRIB', 'truncated' or 'unreadable'
+    # a file that has disappeared raises FileNotFoundError rather than being called unreadable
+    def __checkGrib(self, path, size):
+        if size == 0:
+            return 'empty'
+        try:
+            with open(path, 'rb') as gribby:
+                offset = 0
+                while offset < size:
+                    gribby.seek(offset)
+                    header = gribby.read(16)
+                    if len(header) < 8 or header[0:4] != b'GRIB':
+                        return 'not a GRIB' if offset == 0 else 'truncated'
+                    if header[7] == 2:
+                        if len(header) < 16:
+                            return 'truncated'
+                        length = int.from_bytes(header[8:16], 'big')
+                    elif header[7] == 1:
+                        length = int.from_bytes(header[4:7], 'big')
+                    else:
+                        return 'not a GRIB'
+                    if length < 12 or offset + length > size:
+                        return 'truncated'
+                    gribby.seek(offset + length - 4)
+                    if gribby.read(4) != b'7777':
+                        return 'truncated'
+                    offset = offset + length
+        except FileNotFoundError:
+            raise
+        except OSError:
+            return 'unreadable'
+        return None
+
+
+    # records the decoded array file for a model cycle (see ArrayStore.py), replacing any earlier one
+    # gribCount is how many GRIBs went into it, so a reader can tell if the cycle has grown since
+    def registerArray(self, model, cyclec, path, coordsPath, gribCount):
+        sqlString = 'INSERT OR REPLACE INTO ' + self.constants.get('arrayArchive', 'arrays') + ' (model, cycle, path, coordsPath, gribCount, created) VALUES (?, ?, ?, ?, ?, ?)'
+        self.writer.queue(sqlString, (model, cyclec, path, coordsPath, gribCount, datetime.utcnow()))
+        self.writer.flush()
+
+
+    # returns (array path, coordinates path, GRIB count) for a model cycle's decoded array file, or None if there isn't one
+    def getArray(self, model, cyclec):
+        sqlString = 'SELECT path, coordsPath, gribCount FROM ' + self.constants.get('arrayArchive', 'arrays') + ' WHERE model=? AND cycle=?'
+        return self.connections.reader().execute(sqlString, (model, cyclec)).fetchone()
+
+
+    # returns the number of GRIBs (as downloaded, not regional subsets) held for a model cycle, optionally for one forecast hour
+    def countGribs(self, model, cyclec, fHour=None):
+        sqlString = 'SELECT COUNT(*) FROM ' + self.constants['archive'] + " WHERE model=? AND cycle=? AND region=''"
+        params = (model, cyclec)
+        if fHour is not None:
+            sqlString = sqlString + ' AND fhour=?'
+            params = params + (int(fHour),)
+        return self.connections.reader().execute(sqlString, params).fetchone()[0]
+
+
+    # records the cached ensemble statistics for one forecast hour of a model cycle (see EnsCalculator.py)
+    # members is how many members went into them
+    def registerStats(self, model, cyclec, fHour, path, members):
+        sqlString = 'INSERT OR REPLACE INTO ' + self.constants.get('statsArchive', 'stats') + ' (model, cycle, fhour, path, members, created) VALUES (?, ?, ?, ?, ?, ?)'
+        self.writer.queue(sqlString, (model, cyclec, int(fHour), path, members, datetime.utcnow()))
+
+
+    # returns (path, members) of the cached ensemble statistics for one forecast hour of a model cycle, or None if there aren't any
+    # (or they've been invalidated by a new member arriving)
+    def getStats(self, model, cyclec, fHour):
+        self.writer.flush() # an invalidation may still be queued
+        sqlString = 'SELECT path, members FROM ' + self.constants.get('statsArchive', 'stats') + ' WHERE model=? AND cycle=? AND fhour=?'
+        return self.connections.reader().execute(sqlString, (model, cyclec, int(fHour))).fetchone()
+
+
+    # returns the path to one region's subset of a GRIB, or None if it isn't in the database
+    def getRegionGrib(self, model, cycle, hour, member, fHour, region):
+        sqlString = "SELECT path FROM " + self.constants['archive'] + " WHERE model=? AND cycle=? AND member=? AND fhour=? AND region=?"
+        result = self.connections.reader().execute(sqlString, (model, cycle + str(hour).zfill(2), int(member), int(fHour), region)).fetchone()
+        return None if result is None else result[0]
+
+
+    # deletes a single specified GRIB file (and any regional subsets of it)
     def deleteGrib(self, model, cycle, hour, member, fHour):
-        sqlString = "DELETE FROM " + self.constants['archive'] + " WHERE model='" + model + "' AND cycle='" + cycle + str(hour).zfill(2) + "' AND member='" + str(member) + "' AND fhour='" + str(fHour) + "'"
-        self.curs.execute(sqlString)
-        self.conn.commit()
+        sqlString = "DELETE FROM " + self.constants['archive'] + " WHERE model=? AND cycle=? AND member=? AND fhour=?"
+        self.writer.queue(sqlString, (model, cycle + str(hour).zfill(2), int(member), int(fHour)))
+        self.writer.flush()
+        self.__cacheRemove([(model, cycle + str(hour).zfill(2), int(member), int(fHour))])
 
 
     # returns a list of the unique model cycles available in the database
     def getModelCycles(self, model=None):
+        if self.cycleCounts is not None:
+            return sorted(set(c for (m, c) in self.cycleCounts if model is None or m == model))
+
+        self.writer.flush() # anything still queued has to be visible to the query
         sqlString = "SELECT DISTINCT cycle FROM " + self.constants['archive']
         if model is not None:
-            sqlString = sqlString + " WHERE model='" + model + "'"
-        self.curs.execute(sqlString)
-        result = self.curs.fetchall()
+            sqlString = sqlString + " WHERE model=?"
+            result = self.connections.reader().execute(sqlString + " ORDER BY cycle", (model,)).fetchall()
+        else:
+            result = self.connections.reader().execute(sqlString + " ORDER BY cycle").fetchall()
         return ["".join(item) for item in result]
 
 
+    # asks NOMADS whether a single GRIB is available, without actually downloading it
+    # by default this is a GET for just the first byte (the filter CGI doesn't reliably answer HEAD), with 'probeMethod: head' in the config a HEAD request
+    # answers are cached, see self.probeCache...fresh=True skips the cached answer and always asks NOMADS
+    def probeGrib(self, model, cycle, hour, member=-1, fHour=0, fresh=False):
+        cyclec = cycle + str(hour).zfill(2)
+        key = (model, cyclec, int(member), int(fHour))
+
+        cached = self.probeCache.get(key)
+        if not fresh and cached is not None and (cached[1] is None or cached[1] > time.monotonic()):
+            self.metrics.increment('probes_total', model=model, cycle=cyclec, result='cached')
+            return cached[0]
+
+        start = time.perf_counter()
+        if self.checkForFile(model, cycle, hour, member, fHour)[0]:
+            available = True # already have it locally, so it must have been on NOMADS
+        else:
+            gribUrl = self.__makeWebPath(model, cycle, hour, member, fHour)
+            if self.constants.get('probeMethod', 'range') == 'head':
+                request = url.Request(gribUrl, method='HEAD')
+            else:
+                request = url.Request(gribUrl, headers={'Range': 'bytes=0-0'})
+            # probes go through the circuit breaker like downloads do, so an outage trips it before the downloads start
+            self.breaker.wait()
+            try:
+                with self.session.open(request) as mike:
+                    mike.read(1) # a server that ignores Range would start streaming the whole file, so stop after one byte either way
+                available = True
+                self.breaker.record(True)
+            except HTTPError as hte:
+                available = False
+                self.breaker.record(hte.code < 500) # a 404 just means it isn't out yet
+            except (OSError, timeout, HTTPException): # connection refused/reset, DNS failure, a garbled response...
+                available = False
+                self.breaker.record(False)
+        self.metrics.observe('probe_seconds', time.perf_counter() - start, model=model, cycle=cyclec)
+        self.metrics.increment('probes_total', model=model, cycle=cyclec, result='available' if available else 'unavailable')
+
+        if available:
+            self.probeCache[key] = (True, None)
+        else:
+            self.probeCache[key] = (False, time.monotonic() + self.constants.get('probeBackoff', 600))
+        return available
+
+
     # queries NOMADS to see if a given model run is available
-    # not the most elegant solution, but NOMADS doesn't appear to have an easy way to test if a GRIB exists
-    def queryForGrib(self, model, cycle, hour, member=None, fHour=None):
+    # by default this just probes the control member's f000 GRIB (see probeGrib())...with probe=False it falls back to the old
+    # approach of downloading that GRIB and then deleting its record
+    def queryForGrib(self, model, cycle, hour, member=None, fHour=None, probe=True):
         if member is None:
             member = -1
         if fHour is None:
             fHour = 0
+        if probe:
+            return self.probeGrib(model, cycle, hour, member, fHour)
         try:
             if member is None or fHour is None:
                 fileExists = False
@@ -293,40 +1123,32 @@ class DBManager:
             return False
 
 
-    # TODO testing
     # Returns a list of all the images stored in the database
     def listAllImages(self):
-        sqlString = 'SELECT * FROM ' + self.constants['imgArch'] + ' ORDER BY cycle ASC'
-        self.curs.execute(sqlString)
-        result = self.curs.fetchall()
+        sqlString = 'SELECT * FROM ' + self.constants.get('imgArchive', 'img') + ' ORDER BY cycle ASC'
+        result = self.connections.reader().execute(sqlString).fetchall()
         if result is None:
             raise ValueError('There is no data in the specified database.')
         return result
 
 
-    # TODO testing
-    # Returns the latest image stored in the database
-    # Optionally, specify a model to search by
+    # returns the (model, cycle) of the latest run with images in the database for each model
+    # optionally, for just one model
     def getLatestImage(self, model=None):
+        table = self.constants.get('imgArchive', 'img')
         if model is None:
-            sqlString = "SELECT DISTINCT images.model as im, images.cycle as ic FROM images INNER JOIN ( SELECT model, MAX(cycle) as cycle FROM images ) i ON im=i.model AND ic=i.cycle" # okay does this inner join make any effing sense?
-        else:   
-            sqlString = "SELECT DISTINCT images.model as im, images.cycle as ic FROM images INNER JOIN ( SELECT model, MAX(cycle) as cycle FROM images WHERE model='" + model + "' ) i ON im=i.model AND ic=i.cycle" # lmao how about this one
-
-        self.curs.execute(sqlString)
-        result = self.curs.fetchall()
+            result = self.connections.reader().execute('SELECT model, MAX(cycle) FROM ' + table + ' GROUP BY model').fetchall()
+        else:
+            result = self.connections.reader().execute('SELECT model, MAX(cycle) FROM ' + table + ' WHERE model=? GROUP BY model', (model,)).fetchall()
         if result is None:
             raise ValueError('There is no data for the requested model present in the specified database.')
         return result
 
 
-    # TODO testing
     def checkForImage(self, model, cycle, hour, member, fHour):
         cyclec = cycle + str(hour).zfill(2)
-        sqlString = "SELECT path FROM " + self.constants['imgArchive'] + "WHERE model='" + model + "' AND cycle='" + cyclec + "' AND member='" + str(member) + "' AND fhour = '" + str(fHour).zfill(3) + "'" # build appropriate string
-        
-        self.curs.execute(sqlString)
-        result = self.curs.fetchall()
+        sqlString = "SELECT path FROM " + self.constants.get('imgArchive', 'img') + " WHERE model=? AND cycle=? AND member=? AND fhour=?"
+        result = self.connections.reader().execute(sqlString, (model, cyclec, int(member), int(fHour))).fetchall()
 
         # similar logic to checkForFile()
         # if there is a matching image, return a tuple containing boolean True and the path to the image from the database
@@ -337,76 +1159,369 @@ class DBManager:
             return (False, self.__makeImagePath(model, cycle, hour, member, fHour))
 
 
-    # TODO testing
     def __imageName(self, model, cycle, hour, member, fHour):
         # YYYYMMDD.HHz.fXXX
         memberString = self.__makeMemberString(model, member)
-        imageString = model + '.' + cycle + '.' + str(hour).zfill(2) + '.f' + str(fHour).zfill(3) + '.' + memberString + '.' + self.constants['imgFormat']
+        imageString = model + '.' + cycle + '.' + str(hour).zfill(2) + '.f' + str(fHour).zfill(3) + '.' + memberString + '.' + self.constants.get('imgFormat', 'png')
         return imageString
 
 
-    # TODO testing
-    def __makeImagePath():
+    # images are laid out like GRIBs: imgSrc/model/YYYYMMDDHH/
+    def __makeImagePath(self, model, cycle, hour, member, fHour):
         fileName = self.__imageName(model, cycle, hour, member, fHour)
         cyclec = cycle + str(hour).zfill(2)
-        imgPath = model + '/' + cyclec + '/' + fileName
-        return self.constants['imgSrc'] + localPath
+        return os.path.join(self.constants['imgSrc'], model, cyclec, fileName)
 
 
-    # TODO implement
-    def getMissingImages():
-        Exception('Do we need this in DBManager?')
+    # returns every GRIB (as downloaded) that doesn't have an image yet, optionally for one model and/or a list of cycles (YYYYMMDDHH)
+    # worked out with a single anti-join against the image table, so the cost is in the new GRIBs rather than everything on disk
+    # returns a list of (model, cycle, member, fHour, gribPath, imagePath) in model/cycle/member/fhour order
+    def getMissingImages(self, model=None, cycles=None):
+        self.writer.flush() # anything still queued has to be visible to the query
+        sqlString = 'SELECT g.model, g.cycle, g.member, g.fhour, g.path FROM ' + self.constants['archive'] + " g WHERE g.region=''"
+        params = ()
+        if model is not None:
+            sqlString = sqlString + ' AND g.model=?'
+            params = params + (model,)
+        if cycles is not None:
+            cycles = list(cycles)
+            if len(cycles) == 0:
+                return []
+            sqlString = sqlString + ' AND g.cycle IN (' + ', '.join('?' * len(cycles)) + ')'
+            params = params + tuple(cycles)
+        sqlString = sqlString + ' AND NOT EXISTS (SELECT 1 FROM ' + self.constants.get('imgArchive', 'img') + ' i WHERE i.model=g.model AND i.cycle=g.cycle AND i.member=g.member AND i.fhour=g.fhour)'
+        result = self.connections.reader().execute(sqlString + ' ORDER BY g.model, g.cycle, g.member, g.fhour', params).fetchall()
+        return [(m, cyclec, member, fHour, path, self.__makeImagePath(m, cyclec[0:8], int(cyclec[8:]), member, fHour)) for m, cyclec, member, fHour, path in result]
+
+
+    # records a rendered image in the database
+    # like GRIB rows, the row is queued and goes out with the writer's next batch (see flush())
+    def addImage(self, model, cycle, hour, member, fHour):
+        self.__createNewImage(model, cycle, hour, member, fHour)
 
 
-    # TODO testing
     def __createNewImage(self, model, cycle, hour, member, fHour):
         # start by figuring out where the image belongs on the filesystem
-        # mike would just like to say, for the record, that he's really tired
-        filePath = self.__makeImgPath(model, cycle, hour, member, fHour)
+        filePath = self.__makeImagePath(model, cycle, hour, member, fHour)
         cyclec = cycle + str(hour).zfill(2)
 
-        imgTuple = [(model, cyclec, member, fHour, filePath)]
-    
+        imgTuple = (model, cyclec, int(member), int(fHour), filePath)
+
         # now add the reference to the image database
-        sqlString = 'INSERT INTO ' + self.constants['imgArchive'] + ' VALUES (?, ?, ?, ?, ?)'
-        self.curs.executemany(sqlString, imgTuple)
-        self.conn.commit()
-        
+        sqlString = 'INSERT OR REPLACE INTO ' + self.constants.get('imgArchive', 'img') + ' (model, cycle, member, fhour, path) VALUES (?, ?, ?, ?, ?)'
+        self.writer.queue(sqlString, imgTuple)
+
 
-    # TODO testing
-    # deletes all images older than specified date, optionally for only one specific model
+    # deletes all images older than specified date, optionally for only one specific model, leaving their GRIBs alone
+    # (deleteOldGribs() already takes the images along with the GRIBs)
+    # returns a summary of the form {'cycles': n, 'images': n, 'files': n, 'bytes': n}
     def deleteOldImages(self, olderThan, model=None):
-        # sql query to get the path to any files that will be deleted
-        sqlString = "SELECT path FROM " + self.constants['imgArchive'] + " WHERE cycle < " + olderThan
+        olderThan = str(olderThan)
+        self.writer.flush()
+        models = list(self.models.keys()) if model is None else [model]
+        sqlString = " WHERE cycle < ?"
+        params = (olderThan,)
         if model is not None:
-            sqlString = sqlString + " AND model='" + model + "'"
-        self.curs.execute(sqlString)
-        result = self.curs.fetchall()
-        
-        # for every path that was returned...remove it from the filesystem
-        if result is None:
-            return
-        else:
-            for thing in result:
-                try:
-                    os.remove(thing[0])
-                except OSError:
-                    pass
+            sqlString = sqlString + " AND model=?"
+            params = params + (model,)
+        images = self.connections.reader().execute("SELECT COUNT(*) FROM " + self.constants.get('imgArchive', 'img') + sqlString, params).fetchone()[0]
 
-        # now delete the appropriate references from the database
-        sqlString = "DELETE FROM " + self.constants['imgArchive'] + " WHERE cycle < " + olderThan
-        if model is not None:
-            sqlString = sqlString + " AND model='" + model + "'"
-        self.curs.execute(sqlString)
-        self.conn.commit()
+        imageDirs = set()
+        for m in models:
+            imageDirs.update(self.__cycleDirs(self.constants.get('imgSrc'), m, olderThan))
+        cycles, files, size = self.__purgeCycleDirs(imageDirs)
+
+        self.writer.queue("DELETE FROM " + self.constants.get('imgArchive', 'img') + sqlString, params)
+        self.writer.flush()
+        return {'cycles': cycles, 'images': images, 'files': files, 'bytes': size}
 
 
-    # TODO testing
     # deletes a single image from the database
     def deleteImage(self, model, cycle, hour, member, fHour):
-        sqlString = "DELETE FROM " + constants.archive['imgArchive'] + " WHERE model ='" + model + "' AND cycle='" + cycle + str(hour).zfill(2) + "' AND member='" + str(member) + "' AND fhour='" + str(fHour) + "'"
-        self.curs.execute(sqlString)
-        self.conn.commit()
+        sqlString = "DELETE FROM " + self.constants.get('imgArchive', 'img') + " WHERE model=? AND cycle=? AND member=? AND fhour=?"
+        self.writer.queue(sqlString, (model, cycle + str(hour).zfill(2), int(member), int(fHour)))
+        self.writer.flush()
+
+
+    # publishes a consistent copy of the database to dest (e.g. for the GEPSSoundings site to read) without stalling the writer
+    # the copy is made with sqlite's online backup API from a read-only connection pinned to one WAL snapshot, pages at a time
+    # ('snapshotPages' in the config, default 256) with a short pause between steps ('snapshotPause' seconds, default 0.01), into a
+    # temporary file next to dest that's then renamed over it...so whoever is reading dest only ever sees a complete database
+    # the copy is switched out of WAL mode, so it can be opened from a directory its readers can't write to
+    # returns a summary of the form {'path': dest, 'pages': n, 'bytes': n, 'seconds': s}
+    def publishSnapshot(self, dest, pages=None, pause=None):
+        start = time.perf_counter()
+        if pages is None:
+            pages = self.constants.get('snapshotPages', 256)
+        if pause is None:
+            pause = self.constants.get('snapshotPause', 0.01)
+        self.writer.flush() # so the snapshot includes everything this manager has done
+
+        dest = os.path.abspath(dest)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tempPath = dest + '.part'
+        progress = {'pages': 0}
+        def step(status, remaining, total):
+            progress['pages'] = total
+            if remaining > 0:
+                time.sleep(pause) # give the writer a look in between steps
+
+        readerUri = 'file:' + url.pathname2url(os.path.abspath(self.constants['dbname'])) + '?mode=ro'
+        source = sq.connect(readerUri, uri=True, timeout=60)
+        target = sq.connect(tempPath)
+        try:
+            # holding a read transaction open pins the source to one snapshot, so commits made while the copy is running neither
+            # wait on it nor force it to start over
+            source.execute('BEGIN')
+            source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            source.backup(target, pages=pages, progress=step)
+            source.rollback()
+            target.execute('PRAGMA journal_mode=DELETE')
+            target.commit()
+        except sq.Error:
+            target.close()
+            source.close()
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            raise
+        target.close()
+        source.close()
+
+        with open(tempPath, 'rb') as tempFile:
+            os.fsync(tempFile.fileno())
+        os.replace(tempPath, dest)
+
+        summary = {'path': dest, 'pages': progress['pages'], 'bytes': os.path.getsize(dest), 'seconds': time.perf_counter() - start}
+        self.metrics.observe('snapshot_seconds', summary['seconds'])
+        self.metrics.increment('snapshots_total')
+        return summary
+
+
+    # commits anything still sitting in the writer's batch
+    def flush(self):
+        self.writer.flush()
+
+
+    # flushes any pending writes and closes the database connection, along with any idle NOMADS connections (unless they're shared)
+    def close(self):
+        self.writer.flush()
+        self.connections.close()
+        if not self.shared:
+            self.session.close()
+
+
+
+######################################################################
+#   owns the sqlite connections for a DBManager: a single writer,
+#   plus one read-only (mode=ro) connection per thread that asks for
+#   one, so lookups from any thread never queue up behind a write
+#   transaction (WAL lets them read the last committed state instead)
+#   the writer may be used from any thread, but only under writeLock
+######################################################################
+class ConnectionManager:
+
+
+    def __init__(self, dbname, writeLock=None, timeout=60, cachedStatements=256):
+        self.dbname = dbname
+        self.writeLock = writeLock if writeLock is not None else threading.Lock()
+        self.cachedStatements = cachedStatements
+        # timeout is how long to wait on another connection's write lock...with several DBManagers syncing at once, they take turns
+        # queries are parameterized, so each one is parsed once and then reused from the statement cache
+        self.writer = sq.connect(dbname, timeout=timeout, cached_statements=cachedStatements, check_same_thread=False)
+        # WAL lets the GEPSSoundings readers keep querying while a sync is writing, and with WAL synchronous=NORMAL is still crash-safe
+        self.writer.execute('PRAGMA journal_mode=WAL')
+        self.writer.execute('PRAGMA synchronous=NORMAL')
+        self.writer.execute('PRAGMA cache_size=-16000') # negative means KiB, so ~16 MB of page cache
+        self.local = threading.local()
+        self.readers = [] # every reader handed out, so close() can get them all
+        self.lock = threading.Lock()
+
+
+    # returns this thread's read-only connection, opening it on first use
+    def reader(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            readerUri = 'file:' + url.pathname2url(os.path.abspath(self.dbname)) + '?mode=ro'
+            conn = sq.connect(readerUri, uri=True, timeout=60, cached_statements=self.cachedStatements, check_same_thread=False)
+            conn.execute('PRAGMA cache_size=-4000')
+            self.local.conn = conn
+            with self.lock:
+                self.readers.append(conn)
+        return conn
+
+
+    # closes the writer and every reader
+    def close(self):
+        with self.lock:
+            readers = self.readers
+            self.readers = []
+        for conn in readers:
+            conn.close()
+        self.writer.close()
+
+
+
+######################################################################
+#   batches inventory writes into as few transactions as possible
+#   statements are queued up and executed together in one transaction
+#   once batchSize of them are waiting or the oldest has waited
+#   batchSeconds, or whenever flush() is called
+######################################################################
+class InventoryWriter:
+
+
+    def __init__(self, conn, batchSize=500, batchSeconds=5.0, metrics=None, lock=None):
+        self.conn = conn
+        self.metrics = metrics # optional SyncMetrics to record commit times in
+        self.lock = lock if lock is not None else threading.Lock() # held while a batch is being committed
+        self.batchSize = batchSize
+        self.batchSeconds = batchSeconds
+        self.pending = [] # list of (sqlString, params) in the order they were queued
+        self.pendingRows = {} # key -> params, so callers can see rows that are queued but not committed yet
+        self.deferred = {} # sqlString -> {params: None}, statements run once each at the end of the next batch (see queueOnce())
+        self.oldest = None # time.monotonic() of the oldest queued statement
+        self.commits = 0 # number of transactions committed so far, handy for benchmarking
+
+
+    # queues a statement (with optional parameters) to go out in the next batch
+    # key is an optional lookup key for the row, see lookup()
+    def queue(self, sqlString, params=(), key=None):
+        self.pending.append((sqlString, params))
+        if key is not None:
+            self.pendingRows[key] = params
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+
+        if len(self.pending) >= self.batchSize or time.monotonic() - self.oldest >= self.batchSeconds:
+            self.flush()
+
+
+    # queues a statement to run once at the end of the next batch, however many times it's queued before then
+    # for things like invalidating a cache row for every new GRIB, which would otherwise break the batch up into runs of one
+    def queueOnce(self, sqlString, params=()):
+        self.deferred.setdefault(sqlString, {})[params] = None
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+
+
+    # returns the parameters of a queued-but-uncommitted row by its key, or None
+    def lookup(self, key):
+        return self.pendingRows.get(key)
+
+
+    # writes out everything that's queued in a single transaction
+    # runs of the same statement are handed to executemany() together, followed by everything from queueOnce()
+    def flush(self):
+        if len(self.pending) == 0 and len(self.deferred) == 0:
+            return
+
+        start = time.perf_counter()
+        with self.lock, self.conn: # commits on success, rolls the whole batch back on failure
+            i = 0
+            while i < len(self.pending):
+                sqlString = self.pending[i][0]
+                j = i
+                while j < len(self.pending) and self.pending[j][0] == sqlString:
+                    j = j + 1
+                self.conn.executemany(sqlString, [params for (_, params) in self.pending[i:j]])
+                i = j
+            for sqlString, params in self.deferred.items():
+                self.conn.executemany(sqlString, list(params))
+        self.commits = self.commits + 1
+        if self.metrics is not None:
+            self.metrics.observe('db_commit_seconds', time.perf_counter() - start)
+            self.metrics.increment('db_commits_total')
+            self.metrics.increment('db_statements_total', len(self.pending) + sum(len(params) for params in self.deferred.values()))
+
+        self.pending = []
+        self.pendingRows = {}
+        self.deferred = {}
+        self.oldest = None
+
+
+
+######################################################################
+#   pauses all requests to NOMADS when too many of them are failing
+#   keeps the outcomes of the last `window` requests...once at least
+#   half the window is filled and the error rate reaches `threshold`,
+#   the breaker opens and wait() blocks every caller for `cooldown`
+#   seconds before letting requests through again
+######################################################################
+class CircuitBreaker:
+
+
+    def __init__(self, window=20, threshold=0.5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.outcomes = deque(maxlen=window) # True for a good request, False for a timeout/5xx
+        self.openUntil = 0 # time.monotonic() at which the breaker closes again
+        self.trips = 0 # how many times the breaker has opened
+        self.lock = threading.Lock() # called from the download worker threads
+
+
+    # blocks while the breaker is open
+    def wait(self):
+        while True:
+            with self.lock:
+                remaining = self.openUntil - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+
+    # records the outcome of one request, and opens the breaker if the error rate is too high
+    def record(self, success):
+        with self.lock:
+            self.outcomes.append(success)
+            if len(self.outcomes) < self.outcomes.maxlen / 2:
+                return
+            errorRate = self.outcomes.count(False) / len(self.outcomes)
+            if errorRate >= self.threshold and self.openUntil <= time.monotonic():
+                print('NOMADS error rate at ' + str(int(errorRate * 100)) + '%, pausing requests for ' + str(self.cooldown) + ' seconds')
+                self.openUntil = time.monotonic() + self.cooldown
+                self.trips = self.trips + 1
+                self.outcomes.clear() # start counting afresh once requests resume
+
+
+
+######################################################################
+#   a global budget for talking to NOMADS, shared by every model's
+#   sync: at most maxConcurrent downloads in flight at once, and (if
+#   bytesPerSecond is set) no more than that much total bandwidth,
+#   enforced as a token bucket holding up to one second's worth
+######################################################################
+class SyncBudget:
+
+
+    def __init__(self, maxConcurrent=1, bytesPerSecond=None):
+        self.slots = threading.BoundedSemaphore(maxConcurrent)
+        self.bytesPerSecond = bytesPerSecond
+        self.tokens = bytesPerSecond or 0 # bytes that can be read right now
+        self.refilled = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    # waits for a download slot
+    def acquire(self):
+        self.slots.acquire()
+
+
+    def release(self):
+        self.slots.release()
+
+
+    # accounts for `amount` bytes just read, sleeping if that puts us over the bandwidth limit
+    def consume(self, amount):
+        if not self.bytesPerSecond:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.bytesPerSecond, self.tokens + (now - self.refilled) * self.bytesPerSecond)
+            self.refilled = now
+            self.tokens = self.tokens - amount
+            debt = -self.tokens
+        if debt > 0:
+            time.sleep(debt / self.bytesPerSecond)
 
 
 
@@ -414,3 +1529,8 @@ class GRIBTimeoutError(Exception):
     def __init__(self, message, gribname):
         super().__init__(message)
         self.gribname = gribname 
+
+
+# NOMADS answered with a 5xx...treated like a timeout, since it's usually just the server being overloaded
+class GRIBServerError(GRIBTimeoutError):
+    pass
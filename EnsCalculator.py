@@ -0,0 +1,109 @@
+import os
+import warnings
+import numpy as np
+
+import ArrayStore
+
+######################################################################
+#   Ensemble Calculator                                              #
+#                                                                    #
+#   mean, spread, min/max and percentiles across every member of a   #
+#   forecast hour, computed once from the cycle's array file (see    #
+#   ArrayStore.py) and cached on disk, keyed by (model, cycle,       #
+#   fhour)...a cached result is dropped by DBManager as soon as a    #
+#   new member of that forecast hour is recorded                     #
+#                                                                    #
+#   each statistic is a float32 array shaped                         #
+#       variable x level x lat x lon                                 #
+#   with variables in ArrayStore.VARIABLES order                     #
+######################################################################
+
+# percentiles computed across the members
+PERCENTILES = (10, 25, 50, 75, 90)
+
+
+# returns the path a forecast hour's cached statistics are written to...inside the cycle directory, so purging the cycle takes them with it
+def statsPath(manager, model, cyclec, fHour):
+    return os.path.join(manager.constants['rootSrc'], model, cyclec, 'stats', model + '.' + cyclec + '.f' + str(fHour).zfill(3) + '.stats.npz')
+
+
+# returns the statistics for one forecast hour of a model cycle as a dict of arrays
+# (mean, spread, min, max, percentiles, plus the variables/levels/lats/lons/percentile values they're indexed by),
+# from the cache if it's current, otherwise computed and cached
+# returns None if the cycle has no GRIBs (or no members) for that forecast hour yet
+# raises ValueError for a forecast hour the model doesn't have
+def getEnsembleStats(manager, model, cyclec, fHour):
+    record = manager.getStats(model, cyclec, fHour)
+    if record is not None and os.path.exists(record[0]):
+        with np.load(record[0]) as cached:
+            return {key: cached[key] for key in cached.files}
+    return updateCycleStats(manager, model, cyclec, [fHour]).get(int(fHour))
+
+
+# computes (and caches) the statistics for the given forecast hours of a model cycle, or all of them
+# the cycle's array file is (re)built first if it's missing or older than the GRIBs it came from
+# returns a dict of fhour -> statistics, leaving out forecast hours with no members in yet
+# raises ValueError for a forecast hour that isn't in the cycle's array file
+def updateCycleStats(manager, model, cyclec, fHours=None):
+    manager.flush() # so the GRIB count below sees everything downloaded so far
+    arrays = _currentArray(manager, model, cyclec)
+    if arrays is None:
+        return {}
+    data, coords = arrays
+    if fHours is None:
+        fHours = coords['fhours']
+
+    results = {}
+    for fHour in fHours:
+        f = int(np.searchsorted(coords['fhours'], fHour))
+        if f == len(coords['fhours']) or coords['fhours'][f] != int(fHour):
+            raise ValueError('No forecast hour ' + str(fHour) + ' in ' + model + ' ' + cyclec)
+        # pull the whole forecast hour out as one plain float array, member x variable x level x lat x lon, then reduce over members
+        members = np.stack([data[variable][:, f] for variable in ArrayStore.VARIABLES], axis=1)
+        present = ~np.isnan(members).all(axis=(1, 2, 3, 4))
+        members = members[present] # members that never arrived don't count
+        if len(members) == 0:
+            continue
+        stats = _reduce(members)
+        stats.update({'variables': np.array(ArrayStore.VARIABLES), 'levels': coords['levels'], 'lats': coords['lats'], 'lons': coords['lons'], 'percentileValues': np.array(PERCENTILES)})
+
+        path = statsPath(manager, model, cyclec, int(fHour))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(path + '.part.npz', **stats)
+        os.replace(path + '.part.npz', path)
+        manager.registerStats(model, cyclec, int(fHour), path, int(present.sum()))
+        results[int(fHour)] = stats
+    manager.flush()
+    return results
+
+
+# all the statistics over axis 0 (members) of one forecast hour...NaNs (e.g. levels a member is missing) are skipped
+def _reduce(members):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # levels no member has come out as NaN, which is what we want
+        return _reduceAll(members)
+
+
+def _reduceAll(members):
+    percentiles = np.nanpercentile(members, PERCENTILES, axis=0).astype(np.float32)
+    return {
+        'mean': np.nanmean(members, axis=0).astype(np.float32),
+        'spread': np.nanstd(members, axis=0).astype(np.float32),
+        'min': np.nanmin(members, axis=0),
+        'max': np.nanmax(members, axis=0),
+        'percentiles': percentiles, # percentile x variable x level x lat x lon
+    }
+
+
+# opens the cycle's array file, rebuilding it first if more GRIBs have arrived since it was written
+# returns (data, coords), or None if the cycle has no GRIBs
+def _currentArray(manager, model, cyclec):
+    gribCount = manager.countGribs(model, cyclec)
+    if gribCount == 0:
+        return None
+    record = manager.getArray(model, cyclec)
+    if record is None or record[2] < gribCount:
+        if ArrayStore.buildCycleArray(manager, model, cyclec) is None:
+            return None
+        manager.flush()
+    return ArrayStore.openCycleArray(manager, model, cyclec)
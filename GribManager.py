@@ -1,11 +1,16 @@
 import numpy as np
 import pandas as pd
 import DBManager as dbm
+import ArrayStore
+import EnsCalculator
+import ImageManager
 import pytz
 
+import os
 import sys
 
 from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
 
 ### CONFIGURATION
 
@@ -33,49 +38,102 @@ def getNomadsCycles(manager, model):
     return availableRuns
 
 def updateDatabase(manager, model, text):
-    localCycles = manager.getModelCycles(model) # gets the locally-stored cycles from the db
     nomadsCycles = getNomadsCycles(manager, model) # gets the available cycles from NOMADS
+    availableCycles = [cycle for cycle, available in nomadsCycles.items() if available]
 
-    # determine what cycles are missing from the local store
-    if localCycles is None:
-        missingCycles = list(nomadsCycles.keys())
-    else:
-        missingCycles = []
-        for cycle in nomadsCycles.keys():
-            if cycle not in localCycles:
-                missingCycles.append(cycle)
+    # work out exactly which files are missing from the local store for every available cycle...this catches cycles that
+    # only partly downloaded last time, not just the ones that are missing entirely
+    missingFiles = manager.getMissingGribs(model, availableCycles)
+    missingCycles = [cycle for cycle in availableCycles if len(missingFiles[cycle]) > 0]
 
-    # if there are any missing cycles, attempt to download them
+    # if there are any missing files, attempt to download them
     if len(missingCycles) > 0:
         prompt = 'Preparing to download ' + model + ' runs '
         for cycle in missingCycles:
-            prompt = prompt + cycle + ', '
+            prompt = prompt + cycle + ' (' + str(len(missingFiles[cycle])) + ' files), '
         if text:
             resp = input(prompt + '...proceed?')
             if resp == 'n':
                 return
 
-        # download the missing runs
+        # download the missing files
         for run in missingCycles:
             if text:
                 print('Downloading run ' + str(run) + '\n')
             try:
-                manager.downloadModel(model, run[0:8], int(run[8:]))
+                manager.downloadModel(model, run[0:8], int(run[8:]), files=missingFiles[run])
             except ValueError as v:
                 print(str(v))
+
+            # optionally, decode the cycle into its array file now that it has new GRIBs (see ArrayStore.py), and refresh the cycle's
+            # ensemble statistics (see EnsCalculator.py)...neither is worth losing the rest of the sync over, so a cycle that can't be
+            # decoded (a bad GRIB, no pygrib) is reported and skipped
+            try:
+                if manager.constants.get('arrayStore', False):
+                    ArrayStore.buildCycleArray(manager, model, run)
+                if manager.constants.get('ensembleStats', False):
+                    EnsCalculator.updateCycleStats(manager, model, run) # rebuilds the array file itself if it's stale
+            except Exception as e:
+                print('Could not decode ' + model + ' ' + run + ': ' + type(e).__name__ + ': ' + str(e))
+                manager.metrics.increment('decode_errors_total', model=model)
+
+    if text:
+        for cycle, status in manager.getCompletenessReport(model, availableCycles).items():
+            print(model + ' ' + cycle + ': ' + str(status['present']) + '/' + str(status['expected']) + ' GRIBs' + ('' if status['complete'] else ' (incomplete)'))
     
     # delete the old runs
     oldTime = datetime.utcnow().replace(tzinfo=timezone.utc) - timedelta(hours=hourLimit+6)
-    deleted = manager.deleteOldGribs(oldTime.strftime('%Y%m%d%H'))
+    deleted = manager.deleteOldGribs(oldTime.strftime('%Y%m%d%H'), model)
     return deleted
 
-def updateImages(manager, imgsToDelete=None):
-    pass
-    # first, figure out what images are missing
-
-    # then, generate the proper images for all those files
-
-    # finally, delete the images from old runs
+# runs updateDatabase() for every model in the config at the same time, each with its own DBManager (and so its own sqlite
+# connection) sharing manager's NOMADS session, concurrency/bandwidth budget and write lock
+# returns a dict of model -> whatever updateDatabase() returned for it
+def updateAllModels(manager, text=False):
+    def syncModel(model):
+        modelManager = dbm.DBManager(manager.configPath, shareWith=manager)
+        try:
+            return updateDatabase(modelManager, model, text)
+        finally:
+            modelManager.close()
+
+    with ThreadPoolExecutor(max_workers=len(manager.models)) as pool:
+        futures = {model: pool.submit(syncModel, model) for model in manager.models}
+    # the per-model managers kept their own inventory caches, so the caller's is now out of date
+    if manager.inventory is not None:
+        manager.loadInventory()
+    return {model: future.result() for model, future in futures.items()}
+
+# renders images for every GRIB that doesn't have one yet, one model at a time (each one already spreads its rendering over a
+# process pool, see ImageManager.py)...there's nothing to delete here, since deleteOldGribs() purges images along with their GRIBs
+def updateImages(manager, text=False):
+    rendered = {}
+    for model in manager.models:
+        summary = ImageManager.updateDatabase(manager, model)
+        if text:
+            print(model + ': ' + str(len(summary['rendered'])) + ' images rendered, ' + str(len(summary['failed'])) + ' failed')
+        rendered[model] = summary
+    return rendered
+
+
+# writes the manager's metrics out as a JSON summary and a Prometheus textfile in the 'metricsDir' directory from the config
+def writeMetrics(manager):
+    metricsDir = manager.constants.get('metricsDir')
+    if metricsDir is None:
+        return
+    manager.metrics.writeJson(os.path.join(metricsDir, 'gribmanager.json'))
+    manager.metrics.writePrometheus(os.path.join(metricsDir, 'gribmanager.prom'))
+
+
+# publishes a fresh snapshot of the database to the 'snapshotDest' path from the config (see DBManager.publishSnapshot()), if there is one
+def publishSnapshot(manager, text=False):
+    dest = manager.constants.get('snapshotDest')
+    if dest is None:
+        return None
+    summary = manager.publishSnapshot(dest)
+    if text:
+        print('Published ' + str(summary['bytes']) + ' bytes to ' + summary['path'] + ' in ' + str(round(summary['seconds'], 2)) + 's')
+    return summary
 
 
 # execute
@@ -89,20 +147,32 @@ def main():
     manager = dbm.DBManager('/var/www/html/mike/DBManager/test_config.yml')
 
     # update the databases
-    # TODO see how badly this f's up the time
+    # interactive runs go one model at a time, so the prompts don't get tangled...otherwise every model syncs at once
     if text:
         print('Updating GEFS database...')
-    deleted_gefs = updateDatabase(manager, 'GEFS', text)
+        deleted_gefs = updateDatabase(manager, 'GEFS', text)
         print(deleted_gefs)
-    if text:
         print('Updating GEPS database...')
-    deleted_geps = updateDatabase(manager, 'GEPS', text)
+        deleted_geps = updateDatabase(manager, 'GEPS', text)
         print(deleted_geps)
+    else:
+        updateAllModels(manager)
 
-    # generate new images
-    #print('Generating missing images...')
-    #updateImages(manager)
+    # generate new images, if this install renders them ('renderImages' in the config...needs matplotlib and pygrib)
+    if manager.constants.get('renderImages', False):
+        if text:
+            print('Generating missing images...')
+        updateImages(manager, text)
+
+    # hand the site a consistent copy of the freshly synced database ('snapshotDest' in the config)
+    publishSnapshot(manager, text)
     
+    # closing the connection flushes the last batch and checkpoints the WAL back into base.db
+    manager.close()
+
+    # dump this run's download/DB metrics, if there's somewhere to put them
+    writeMetrics(manager)
+
     if text:
         print('Database should now be up-to-date.')
 
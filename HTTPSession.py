@@ -0,0 +1,231 @@
+import http.client
+import ssl
+import threading
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit, urljoin
+
+######################################################################
+#   HTTP Session                                                     #
+#                                                                    #
+#   keep-alive connection pooling for NOMADS requests, so the        #
+#   hundreds of GRIBs in a cycle share a handful of TCP/TLS          #
+#   connections instead of handshaking once per file                 #
+#                                                                    #
+#   open() raises the same exceptions urllib.request.urlopen() does  #
+#   (HTTPError for 4xx/5xx, URLError for connection failures), so    #
+#   callers can swap one for the other                               #
+######################################################################
+class HTTPSession:
+
+
+    # maxPerHost bounds the number of connections (idle or busy) to any one host...callers block until one frees up
+    def __init__(self, maxPerHost=4, timeout=30):
+        self.maxPerHost = maxPerHost
+        self.timeout = timeout
+        self.sslContext = ssl.create_default_context()
+        self.condition = threading.Condition() # guards everything below, and wakes threads waiting for a connection
+        self.idle = {} # (scheme, host, port) -> list of idle connections
+        self.active = {} # (scheme, host, port) -> number of open connections, idle or busy
+        self.counts = {'requests': 0, 'connectionsOpened': 0, 'reused': 0, 'discarded': 0}
+
+
+    # sends a request and returns a PooledResponse, which should be used as a context manager (or closed) so the connection goes back to the pool
+    # request can be a URL string or a urllib.request.Request (its method and headers are honoured)
+    def open(self, request, timeout=None, redirects=5):
+        if isinstance(request, str):
+            requestUrl, method, headers = request, 'GET', {}
+        else:
+            requestUrl, method, headers = request.full_url, request.get_method(), dict(request.header_items())
+        if timeout is None:
+            timeout = self.timeout
+
+        response = self.__send(requestUrl, method, headers, timeout)
+
+        # follow redirects the way urlopen() would
+        if response.status in (301, 302, 303, 307, 308) and response.getheader('Location') is not None and redirects > 0:
+            location = urljoin(requestUrl, response.getheader('Location'))
+            response.close()
+            return self.open(location if method != 'HEAD' else _Head(location, headers), timeout, redirects - 1)
+
+        if response.status >= 400:
+            response.read() # drain the error body so the connection can go back in the pool
+            response.close()
+            raise HTTPError(requestUrl, response.status, response.reason, response.headers, None)
+        return response
+
+
+    # returns a copy of the connection statistics
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counts)
+        stats['reuseRate'] = round(stats['reused'] / stats['requests'], 3) if stats['requests'] else None
+        return stats
+
+
+    # closes every idle connection
+    def close(self):
+        with self.condition:
+            idle = self.idle
+            self.idle = {}
+        for key, connections in idle.items():
+            for conn in connections:
+                conn.close()
+                self.__release(key)
+
+
+    def __send(self, requestUrl, method, headers, timeout):
+        parts = urlsplit(requestUrl)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path = path + '?' + parts.query
+
+        conn, reused = self.__checkout(key, timeout)
+        try:
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused:
+                    raise
+                # the server dropped an idle keep-alive connection on us...try once more on a fresh one
+                conn.close()
+                conn = self.__connect(key, timeout)
+                reused = False
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+        except OSError as e:
+            conn.close()
+            self.__release(key)
+            raise URLError(e)
+        except BaseException:
+            conn.close()
+            self.__release(key)
+            raise
+
+        with self.condition:
+            self.counts['requests'] = self.counts['requests'] + 1
+            if reused:
+                self.counts['reused'] = self.counts['reused'] + 1
+        return PooledResponse(self, key, conn, response)
+
+
+    # takes an idle connection to the host if there is one, otherwise opens a new one (blocking while the host is at maxPerHost)
+    # returns (connection, whether it was reused)
+    def __checkout(self, key, timeout):
+        with self.condition:
+            while True:
+                idle = self.idle.get(key)
+                if idle:
+                    conn = idle.pop()
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return (conn, True)
+                if self.active.get(key, 0) < self.maxPerHost:
+                    self.active[key] = self.active.get(key, 0) + 1
+                    break
+                self.condition.wait() # at the limit and nothing idle, so wait for a connection to come back
+        return (self.__connect(key, timeout), False)
+
+
+    def __connect(self, key, timeout):
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout, context=self.sslContext)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        with self.condition:
+            self.counts['connectionsOpened'] = self.counts['connectionsOpened'] + 1
+        return conn
+
+
+    # hands a connection back to the pool once its response has been fully read
+    def checkin(self, key, conn):
+        with self.condition:
+            self.idle.setdefault(key, []).append(conn)
+            self.condition.notify()
+
+
+    # gives up a connection that can't be reused
+    def discard(self, key, conn):
+        conn.close()
+        with self.condition:
+            self.counts['discarded'] = self.counts['discarded'] + 1
+        self.__release(key)
+
+
+    def __release(self, key):
+        with self.condition:
+            self.active[key] = self.active[key] - 1
+            self.condition.notify()
+
+
+
+# wraps an http.client response so that closing it returns the connection to its pool...if the body was read to the end and the
+# server agreed to keep the connection open, it's reused, otherwise it's closed
+class PooledResponse:
+
+
+    def __init__(self, session, key, conn, response):
+        self.session = session
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.returned = False
+
+
+    def read(self, amount=None):
+        return self.response.read(amount)
+
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+
+    def close(self):
+        if self.returned:
+            return
+        self.returned = True
+        # a small unread remainder (e.g. a HEAD, or a one-byte range) is cheaper to drain than to throw the connection away
+        if not self.response.isclosed() and self.response.length is not None and self.response.length <= 65536:
+            try:
+                self.response.read()
+            except OSError:
+                pass
+        if self.response.isclosed() and not self.response.will_close:
+            self.session.checkin(self.key, self.conn)
+        else:
+            self.response.close()
+            self.session.discard(self.key, self.conn)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+
+
+# a bare HEAD request, for following redirects of one
+class _Head:
+
+
+    def __init__(self, full_url, headers):
+        self.full_url = full_url
+        self.headers = headers
+
+
+    def get_method(self):
+        return 'HEAD'
+
+
+    def header_items(self):
+        return list(self.headers.items())
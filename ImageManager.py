@@ -1,38 +1,126 @@
 import numpy as np
 import pandas as pd
 import DBManager as dbm
+import ArrayStore
 import pytz
 
-import EnsCalculator as ec
+import os
+import time
 
-def updateDatabase():
-	# first, look in the grib db to see what GRIBs are available
-	gribs = manager.getModelCycles()
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-	# second, look in the img db to see what images exist
-	images = manager.getImageCycles()
+# matplotlib is only needed to render images, so the rest of the package works without it
+try:
+	import matplotlib
+	matplotlib.use('Agg')
+	import matplotlib.pyplot as plt
+except ImportError:
+	plt = None
 
-	# for any available GRIBs that don't have corresponding images, generate the images
-	missingImages = []
-	for grib in gribs:
-		if grib not in images:
-			missingImages.append(grib)
+# renders an image for every GRIB of a model that doesn't have one yet
+# the missing images come from a single anti-join in the database (see DBManager.getMissingImages()), so each run only renders
+# what's new, and the rendering is spread over a pool of worker processes...'imageWorkers' in the config, or one per CPU
+# the database rows are queued as each image finishes and committed in batches
+# old images are purged along with their GRIBs by DBManager.deleteOldGribs()
+# returns a summary of the form {'rendered': [(cycle, member, fHour), ...], 'failed': [(cycle, member, fHour), ...]}
+def updateDatabase(manager, model, workers=None):
+	if plt is None:
+		raise ImportError('matplotlib is needed to render images')
+	start = time.perf_counter()
+	summary = {'rendered': [], 'failed': []}
+	missingImages = manager.getMissingImages(model)
+	if len(missingImages) == 0:
+		return summary
 
-	for thing in missingImages:
-		
+	if workers is None:
+		workers = manager.constants.get('imageWorkers', os.cpu_count())
+	lat, lon = soundingPoint(manager)
 
-	# delete old images
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		futures = {}
+		for m, cyclec, member, fHour, gribPath, imagePath in missingImages:
+			title = m + ' ' + cyclec + 'z ' + ('control' if member == -1 else 'member ' + str(member).zfill(2)) + ' f' + str(fHour).zfill(3)
+			futures[pool.submit(renderSounding, gribPath, imagePath, lat, lon, title)] = (cyclec, member, fHour)
+
+		for future in as_completed(futures):
+			cyclec, member, fHour = futures[future]
+			try:
+				future.result()
+			except Exception as e: # one bad GRIB shouldn't cost the rest of the batch...it'll be picked up again next run
+				print('Could not render ' + model + ' ' + cyclec + ' ' + str(member) + ' f' + str(fHour).zfill(3) + ': ' + str(e))
+				summary['failed'].append((cyclec, member, fHour))
+				continue
+			manager.addImage(model, cyclec[0:8], int(cyclec[8:]), member, fHour)
+			summary['rendered'].append((cyclec, member, fHour))
+	manager.flush()
+
+	manager.metrics.observe('image_render_seconds', time.perf_counter() - start, model=model)
+	manager.metrics.increment('images_rendered_total', len(summary['rendered']), model=model)
+	manager.metrics.increment('images_failed_total', len(summary['failed']), model=model)
+	return summary
+
+# the point soundings are drawn for: the middle of the box GRIBs are cut to in the config
+def soundingPoint(manager):
+	constants = manager.constants
+	return ((constants['toplat'] + constants['bottomlat']) / 2.0, (constants['leftlon'] + constants['rightlon']) / 2.0)
+
+# draws the temperature/dewpoint sounding (with winds) at one point of a GRIB and saves it to imagePath
+# runs in a worker process, so it only takes plain arguments and never touches the database
+def renderSounding(gribPath, imagePath, lat, lon, title):
+	profile = ArrayStore.readProfile(gribPath, lat, lon)
+	levels = np.array(sorted(profile['TMP'], reverse=True), dtype=float)
+	if len(levels) == 0:
+		raise ValueError('no temperature levels in ' + gribPath)
+	temp = np.array([profile['TMP'][level] for level in levels]) - 273.15
+	rh = np.array([profile['RH'].get(level, np.nan) for level in levels])
+	dewpoint = dewpointFrom(temp, rh)
+
+	fig, ax = plt.subplots(figsize=(6, 8))
+	ax.semilogy(temp, levels, color='red', label='Temperature')
+	ax.semilogy(dewpoint, levels, color='green', label='Dewpoint')
+	windLevels = [level for level in levels if level in profile['UGRD'] and level in profile['VGRD']]
+	if len(windLevels) > 0:
+		# knots, for the barbs
+		u = np.array([profile['UGRD'][level] for level in windLevels]) * 1.94384
+		v = np.array([profile['VGRD'][level] for level in windLevels]) * 1.94384
+		ax.barbs(np.full(len(windLevels), np.nanmax(temp) + 10), windLevels, u, v, length=6)
+	ax.set_ylim(levels.max(), levels.min())
+	ax.set_yticks(levels)
+	ax.set_yticklabels([str(int(level)) for level in levels])
+	ax.minorticks_off()
+	ax.set_xlabel('°C')
+	ax.set_ylabel('mb')
+	ax.set_title(title)
+	ax.grid(True, alpha=0.3)
+	ax.legend(loc='lower left')
+
+	# written next to its final name and renamed into place, like downloads, so a half-drawn image is never picked up
+	os.makedirs(os.path.dirname(imagePath), exist_ok=True)
+	imageFormat = os.path.splitext(imagePath)[1][1:]
+	tempPath = imagePath + '.part'
+	try:
+		fig.savefig(tempPath, format=imageFormat, dpi=100)
+	finally:
+		plt.close(fig)
+	os.replace(tempPath, imagePath)
+	return imagePath
+
+# dewpoint (°C) from temperature (°C) and relative humidity (%), via the Magnus approximation
+def dewpointFrom(temp, rh):
+	with np.errstate(divide='ignore', invalid='ignore'):
+		gamma = np.log(np.clip(rh, 1e-3, 100) / 100.0) + (17.62 * temp) / (243.12 + temp)
+		return 243.12 * gamma / (17.62 - gamma)
 
 #execute
 def main():
 	manager = dbm.DBManager('test_config.yml')
-	
-	print('Updating GEFS image data...')
-	deleted_gefs_imgs = updateDatabase(manager, 'GEFS')
 
-	print('Updating GEPS image data...')
-	deleted_geps_imgs = updateDatabase(manager, 'GEPS')
+	for model in manager.models:
+		print('Updating ' + model + ' image data...')
+		summary = updateDatabase(manager, model)
+		print(str(len(summary['rendered'])) + ' rendered, ' + str(len(summary['failed'])) + ' failed')
 
+	manager.close()
 	print('Images should now be up-to-date')
 
 if __name__ == "__main__":
@@ -0,0 +1,206 @@
+import http.server
+import random
+import re
+import threading
+import time
+import yaml
+from urllib.parse import urlparse, parse_qs
+
+######################################################################
+#   NOMADS Stand-in                                                  #
+#                                                                    #
+#   a local HTTP server that answers the same filter-CGI URLs as     #
+#   nomads.ncep.noaa.gov (see urlPatterns in db_config.yml), so that #
+#   syncs can be benchmarked and regression-tested offline           #
+#                                                                    #
+#   every GRIB it serves is a synthetic single-message GRIB2 file    #
+######################################################################
+class NomadsStandin:
+
+
+    # latency: seconds to wait before answering each request
+    # bandwidth: bytes/second to stream response bodies at (None for as fast as possible)
+    # errorRate: fraction of requests answered with a 503
+    # timeoutRate: fraction of requests that hang for `hang` seconds without answering, to trip client timeouts
+    # size: size in bytes of each GRIB served
+    # cycles: the YYYYMMDDHH cycles that are published (None means every cycle is)
+    # maxFHour: cycle -> last published forecast hour, to simulate a cycle that's still coming in
+    # missing: set of (cycle, member name, fhour) files that are never published, e.g. ('2022101500', 'gep03', 12)
+    def __init__(self, port=0, latency=0.0, bandwidth=None, errorRate=0.0, timeoutRate=0.0, hang=35.0, size=65536, cycles=None, maxFHour=None, missing=None, seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.errorRate = errorRate
+        self.timeoutRate = timeoutRate
+        self.hang = hang
+        self.size = size
+        self.cycles = None if cycles is None else set(cycles)
+        self.maxFHour = {} if maxFHour is None else maxFHour
+        self.missing = set() if missing is None else set(missing)
+        self.random = random.Random(seed)
+
+        # request tallies, see stats()
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, 'served': 0, 'notFound': 0, 'errors': 0, 'timeouts': 0, 'bytes': 0}
+
+        standin = self
+        class Handler(StandinHandler):
+            server_standin = standin
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+
+    # base URL to substitute for https://nomads.ncep.noaa.gov in the url patterns
+    def baseUrl(self):
+        return 'http://127.0.0.1:' + str(self.port)
+
+
+    # starts serving on a background thread
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    # returns a copy of the request tallies
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.counts[key] = self.counts[key] + amount
+
+
+    # returns True if the file is published, given its cycle (YYYYMMDDHH), NOMADS member name and forecast hour
+    def isPublished(self, cyclec, memberName, fHour):
+        if self.cycles is not None and cyclec not in self.cycles:
+            return False
+        if cyclec in self.maxFHour and fHour > self.maxFHour[cyclec]:
+            return False
+        return (cyclec, memberName, fHour) not in self.missing
+
+
+    # the synthetic GRIB body...one GRIB2 message: a real indicator section (section 0: 'GRIB', two reserved bytes, discipline 0,
+    # edition 2, then the total length as 8 bytes big-endian), filler in place of sections 1-7, and the end section '7777'
+    def gribBody(self):
+        length = max(self.size, 20)
+        return b'GRIB' + b'\0\0' + b'\0' + b'\2' + length.to_bytes(8, 'big') + b'\0' * (length - 20) + b'7777'
+
+
+    # rewrites a DBManager config so it points at this stand-in, keeps its data under rootSrc/dbname, and applies any constant overrides
+    # writes the result to outPath and returns it
+    def writeConfig(self, configPath, outPath, rootSrc, dbname, constants=None, models=None):
+        with open(configPath, 'r') as configFile:
+            config = yaml.safe_load(configFile)
+        config['constants']['rootSrc'] = rootSrc
+        config['constants']['dbname'] = dbname
+        config['constants'].update(constants or {})
+        for model, overrides in (models or {}).items():
+            config['models'][model].update(overrides)
+        for model in config['urlPatterns']:
+            config['urlPatterns'][model] = config['urlPatterns'][model].replace('https://nomads.ncep.noaa.gov', self.baseUrl())
+        with open(outPath, 'w') as configFile:
+            yaml.safe_dump(config, configFile)
+        return outPath
+
+
+
+# answers filter-CGI requests of the form /cgi-bin/filter_*.pl?file=<member>.tHHz.pgrb2a.0p50.fXXX&...&dir=/<model>.YYYYMMDD/HH/...
+class StandinHandler(http.server.BaseHTTPRequestHandler):
+
+    server_standin = None
+    protocol_version = 'HTTP/1.1' # keep-alive, like the real server
+
+    fileRegex = re.compile(r'^(?P<member>[a-z_]+\d\d)\.t(?P<hour>\d\d)z\..*\.f(?P<fhour>\d{3})$')
+    dirRegex = re.compile(r'\.(?P<date>\d{8})/(?P<hour>\d\d)')
+
+
+    def do_GET(self):
+        self.answer(True)
+
+
+    def do_HEAD(self):
+        self.answer(False)
+
+
+    def answer(self, sendBody):
+        standin = self.server_standin
+        standin.count('requests')
+        if standin.latency > 0:
+            time.sleep(standin.latency)
+
+        query = parse_qs(urlparse(self.path).query)
+        fileMatch = self.fileRegex.match(query.get('file', [''])[0])
+        dirMatch = self.dirRegex.search(query.get('dir', [''])[0])
+        if fileMatch is None or dirMatch is None:
+            self.sendEmpty(400)
+            return
+
+        # roll the dice for injected failures
+        with standin.lock:
+            roll = standin.random.random()
+        if roll < standin.timeoutRate:
+            standin.count('timeouts')
+            time.sleep(standin.hang)
+            self.close_connection = True
+            return
+        if roll < standin.timeoutRate + standin.errorRate:
+            standin.count('errors')
+            self.sendEmpty(503)
+            return
+
+        cyclec = dirMatch.group('date') + dirMatch.group('hour')
+        if not standin.isPublished(cyclec, fileMatch.group('member'), int(fileMatch.group('fhour'))):
+            standin.count('notFound')
+            self.sendEmpty(404)
+            return
+
+        body = standin.gribBody()
+        status = 200
+        requested = self.headers.get('Range')
+        if requested is not None:
+            rangeMatch = re.match(r'bytes=(\d+)-(\d*)', requested)
+            if rangeMatch is not None:
+                start = int(rangeMatch.group(1))
+                end = int(rangeMatch.group(2)) if rangeMatch.group(2) else len(body) - 1
+                body = body[start:end + 1]
+                status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if sendBody:
+            self.sendThrottled(body)
+        standin.count('served')
+
+
+    # writes the body out in chunks, sleeping between them to hold to the configured bandwidth
+    def sendThrottled(self, body):
+        standin = self.server_standin
+        chunkSize = 16384
+        for i in range(0, len(body), chunkSize):
+            chunk = body[i:i + chunkSize]
+            self.wfile.write(chunk)
+            standin.count('bytes', len(chunk))
+            if standin.bandwidth:
+                time.sleep(len(chunk) / standin.bandwidth)
+
+
+    def sendEmpty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+    # keep the benchmark output clean
+    def log_message(self, format, *args):
+        pass
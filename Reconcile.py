@@ -0,0 +1,35 @@
+import sys
+
+import DBManager as dbm
+
+######################################################################
+#   Archive Reconciliation                                           #
+#                                                                    #
+#   checks the GRIBs under rootSrc against the grib table and        #
+#   reports rows with no file, files with no row, empty/truncated    #
+#   GRIBs and leftover temp files (see                               #
+#   DBManager.reconcileArchive())...with 'repair', fixes them too    #
+######################################################################
+
+# execute
+# python Reconcile.py <config> [model] [repair]
+def main():
+    configPath = sys.argv[1] if len(sys.argv) >= 2 else '/var/www/html/mike/DBManager/test_config.yml'
+    args = sys.argv[2:]
+    repair = 'repair' in args
+    models = [arg for arg in args if arg != 'repair']
+
+    manager = dbm.DBManager(configPath)
+    try:
+        for model in (models or [None]):
+            summary = manager.reconcileArchive(model, repair=repair)
+            print((model or 'all models') + ': scanned ' + str(summary['scanned']) + ' GRIBs in ' + str(round(summary['seconds'], 2)) + 's')
+            for key in ('missing', 'corrupt', 'orphans', 'partials', 'adopted', 'removed', 'errors'):
+                print('  ' + key + ': ' + str(len(summary[key])))
+                for item in summary[key][0:10]:
+                    print('    ' + str(item))
+    finally:
+        manager.close()
+
+if __name__ == "__main__":
+    main()
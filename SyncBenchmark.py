@@ -0,0 +1,114 @@
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+import yaml
+
+import DBManager as dbm
+import GribManager as gm
+from NomadsStandin import NomadsStandin
+
+######################################################################
+#   Sync Benchmark                                                   #
+#                                                                    #
+#   runs DBManager.downloadModel() and GribManager.updateDatabase()  #
+#   against a local NOMADS stand-in and reports files/sec, wall      #
+#   time, peak RSS, DB commits and HTTP connection reuse, as JSON    #
+#                                                                    #
+#   ex: python SyncBenchmark.py --workers 8 --latency 0.05           #
+######################################################################
+
+# runs one benchmark scenario in a scratch directory and returns its results as a dict
+# mode is 'model' (one downloadModel() of a single cycle), 'update' (a full GribManager.updateDatabase() of the look-back window)
+# or 'all' (GribManager.updateAllModels(), every model in the config syncing at once)
+def runScenario(mode, model, configPath, standinArgs, constants, fHours=None, members=None):
+    standin = NomadsStandin(**standinArgs).start()
+    try:
+        with tempfile.TemporaryDirectory() as scratch:
+            overrides = {}
+            if fHours is not None:
+                overrides['fHours'] = fHours
+            if members is not None:
+                overrides['members'] = members
+            with open(configPath, 'r') as configFile:
+                models = yaml.safe_load(configFile)['models'].keys()
+            config = standin.writeConfig(configPath, os.path.join(scratch, 'config.yml'), os.path.join(scratch, 'grib') + '/', os.path.join(scratch, 'base.db'), constants, {m: overrides for m in models})
+            manager = dbm.DBManager(config)
+
+            start = time.perf_counter()
+            if mode == 'model':
+                summary = manager.downloadModel(model, '20221015', 0)
+                succeeded, failed = len(summary['succeeded']), len(summary['failed'])
+            elif mode == 'update':
+                gm.updateDatabase(manager, model, False)
+                succeeded, failed = len(manager.listAllGribs()), None
+            else:
+                gm.updateAllModels(manager)
+                succeeded, failed = len(manager.listAllGribs()), None
+            wall = time.perf_counter() - start
+
+            result = {
+                'mode': mode,
+                'model': model if mode != 'all' else 'all',
+                'files': succeeded,
+                'failed': failed,
+                'wallSeconds': round(wall, 3),
+                'filesPerSecond': round(succeeded / wall, 2) if wall > 0 else None,
+                'peakRssKiB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, # KiB on Linux
+                'dbCommits': sum(c['value'] for c in manager.metrics.summary()['counters'] if c['name'] == 'db_commits_total'), # across every DBManager sharing the metrics
+                'http': manager.session.stats(),
+                'server': standin.stats(),
+            }
+            manager.close()
+            return result
+    finally:
+        standin.stop()
+
+
+# parses KEY=VALUE constant overrides, with the value read as YAML so numbers/booleans come through typed
+def parseConstants(pairs):
+    constants = {}
+    for pair in pairs:
+        key, value = pair.split('=', 1)
+        constants[key] = yaml.safe_load(value)
+    return constants
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark GRIB syncs against a local NOMADS stand-in.')
+    parser.add_argument('--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_config.yml'))
+    parser.add_argument('--model', default='GEFS')
+    parser.add_argument('--mode', choices=['model', 'update', 'all', 'both'], default='both', help="'both' runs 'model' then 'update'")
+    parser.add_argument('--fhours', type=int, help='override the last forecast hour, to shrink or grow a cycle')
+    parser.add_argument('--members', type=int, help='override the number of perturbation members')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds of server latency per request')
+    parser.add_argument('--bandwidth', type=float, help='server bandwidth in bytes/second')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with a 503')
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help='fraction of requests that hang past the client timeout')
+    parser.add_argument('--size', type=int, default=65536, help='size of each GRIB in bytes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--constant', action='append', default=[], metavar='KEY=VALUE', help='override a DBManager constant, e.g. --constant retryBase=0.1')
+    parser.add_argument('--output', help='append the JSON results to this file as well as printing them')
+    args = parser.parse_args()
+
+    # keep injected timeouts from dominating the run...the client gives up after 2 s, and the server hangs just past that
+    constants = {'workers': args.workers, 'timeout': 2, 'retryBase': 0.5}
+    constants.update(parseConstants(args.constant))
+    standinArgs = {'latency': args.latency, 'bandwidth': args.bandwidth, 'errorRate': args.error_rate, 'timeoutRate': args.timeout_rate,
+                   'hang': constants['timeout'] + 1, 'size': args.size, 'seed': args.seed}
+
+    modes = ['model', 'update'] if args.mode == 'both' else [args.mode]
+    for mode in modes:
+        result = runScenario(mode, args.model, args.config, standinArgs, constants, args.fhours, args.members)
+        line = json.dumps(result)
+        print(line)
+        if args.output:
+            with open(args.output, 'a') as outFile:
+                outFile.write(line + '\n')
+
+
+if __name__ == "__main__":
+    main()
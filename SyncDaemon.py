@@ -0,0 +1,197 @@
+import heapq
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import DBManager as dbm
+import GribManager as gm
+
+######################################################################
+#   Sync Daemon                                                      #
+#                                                                    #
+#   a long-running alternative to running GribManager from cron      #
+#   instead of rescanning the whole look-back window every run, it   #
+#   keeps a schedule of when each forecast hour of each model cycle  #
+#   should show up on NOMADS, polls only for the next one due, and   #
+#   pulls every member of that forecast hour as soon as it appears   #
+#                                                                    #
+#   schedule settings (all optional, per model or in constants):     #
+#     publishDelay: hours after init time that f000 usually appears  #
+#     fhourDelay:   minutes between successive forecast hours        #
+#     pollInterval: seconds between polls for a late forecast hour   #
+#     purgeInterval: seconds between purges of old cycles            #
+######################################################################
+class SyncDaemon:
+
+
+    def __init__(self, manager, text=False):
+        self.manager = manager
+        self.text = text
+        self.queue = [] # heap of (when to check, model, cycle YYYYMMDDHH, forecast hour)
+        self.scheduled = set() # (model, cycle) pairs already on the schedule
+        self.queued = set() # (model, cycle, forecast hour) entries currently in the queue, so none is queued twice
+        self.nextPurge = 0
+        self.stopEvent = threading.Event()
+
+
+    # looks up a schedule setting for a model, falling back to constants and then to default
+    def setting(self, model, name, default):
+        return self.manager.models[model].get(name, self.manager.constants.get(name, default))
+
+
+    # queues a check of one forecast hour, unless one is queued already
+    def push(self, when, model, cyclec, fHour):
+        if (model, cyclec, fHour) in self.queued:
+            return
+        self.queued.add((model, cyclec, fHour))
+        heapq.heappush(self.queue, (when, model, cyclec, fHour))
+
+
+    # True while a cycle is still inside the look-back window, i.e. still worth polling for
+    def inWindow(self, cyclec):
+        return datetime.strptime(cyclec, '%Y%m%d%H').replace(tzinfo=timezone.utc) >= datetime.now(timezone.utc) - timedelta(hours=gm.hourLimit)
+
+
+    # returns the expected publish time (epoch seconds) of one forecast hour of a cycle
+    def publishTime(self, model, cyclec, fHour):
+        initTime = datetime.strptime(cyclec, '%Y%m%d%H').replace(tzinfo=timezone.utc)
+        delay = timedelta(hours=self.setting(model, 'publishDelay', 3.5)) + timedelta(minutes=fHour / self.manager.models[model]['increment'] * self.setting(model, 'fhourDelay', 1))
+        return (initTime + delay).timestamp()
+
+
+    # returns every cycle of the model from the start of the look-back window up to the next one due to be initialized
+    def cyclesInWindow(self, model, now):
+        interval = self.manager.models[model]['increment']
+        base = self.manager.models[model]['base']
+        earlier = now - timedelta(hours=gm.hourLimit)
+        cycleTime = datetime(year=earlier.year, month=earlier.month, day=earlier.day, hour=base + interval * int(earlier.hour / interval), tzinfo=timezone.utc)
+        cycles = []
+        while cycleTime <= now + timedelta(hours=interval):
+            cycles.append(cycleTime.strftime('%Y%m%d%H'))
+            cycleTime = cycleTime + timedelta(hours=interval)
+        return cycles
+
+
+    # puts any cycles in the window that aren't on the schedule yet onto it
+    # for each cycle, the first forecast hour still missing locally is scheduled at its expected publish time (or right away if that's passed)
+    def scheduleCycles(self, now):
+        for model in self.manager.models:
+            cycles = [c for c in self.cyclesInWindow(model, now) if (model, c) not in self.scheduled]
+            if len(cycles) == 0:
+                continue
+            missing = self.manager.getMissingGribs(model, cycles)
+            for cyclec in cycles:
+                self.scheduled.add((model, cyclec))
+                fHours = sorted(set(i for (j, i) in missing[cyclec]))
+                if len(fHours) > 0:
+                    self.push(self.publishTime(model, cyclec, fHours[0]), model, cyclec, fHours[0])
+
+
+    # checks whether one forecast hour has been published, and if so downloads every member of it that's missing
+    # then schedules the next forecast hour, and the same one again after pollInterval if it isn't out yet or some of its members
+    # didn't come down (not published yet, or out of retries)
+    def check(self, model, cyclec, fHour, now):
+        cycle, hour = cyclec[0:8], int(cyclec[8:])
+        pollInterval = self.setting(model, 'pollInterval', 120)
+        if not self.manager.probeGrib(model, cycle, hour, -1, fHour, fresh=True):
+            # give up on a cycle once it falls out of the look-back window
+            if self.inWindow(cyclec):
+                self.push(now + pollInterval, model, cyclec, fHour)
+            return
+
+        missing = self.manager.getMissingGribs(model, [cyclec])[cyclec]
+        files = [f for f in missing if f[1] == fHour]
+        if self.text:
+            print('Downloading ' + model + ' ' + cyclec + ' f' + str(fHour).zfill(3) + ' (' + str(len(files)) + ' files)')
+        if len(files) > 0:
+            self.manager.downloadModel(model, cycle, hour, files=files)
+            try:
+                gm.publishSnapshot(self.manager, self.text) # the site gets every forecast hour as soon as it's in
+            except Exception as e: # a bad snapshotDest shouldn't hold up the downloads
+                self.report('publish', model, e)
+            missing = self.manager.getMissingGribs(model, [cyclec])[cyclec] # what's still missing after the download
+
+        # anything of this forecast hour that didn't come down gets another go later
+        if any(i == fHour for (j, i) in missing) and self.inWindow(cyclec):
+            self.push(now + pollInterval, model, cyclec, fHour)
+
+        # on to the next forecast hour that's still missing, if any
+        later = sorted(set(i for (j, i) in missing if i > fHour))
+        if len(later) > 0:
+            self.push(max(now, self.publishTime(model, cyclec, later[0])), model, cyclec, later[0])
+
+
+    # purges old cycles if the purge timer is up
+    def purge(self, now):
+        if now < self.nextPurge:
+            return
+        oldTime = datetime.now(timezone.utc) - timedelta(hours=gm.hourLimit + 6)
+        for model in self.manager.models:
+            deleted = self.manager.deleteOldGribs(oldTime.strftime('%Y%m%d%H'), model)
+            if self.text:
+                print('Purged ' + model + ': ' + str(deleted))
+        self.scheduled = set(key for key in self.scheduled if key[1] >= oldTime.strftime('%Y%m%d%H'))
+        gm.writeMetrics(self.manager)
+        self.nextPurge = now + self.manager.constants.get('purgeInterval', 3600)
+
+
+    # prints and counts an error from one step of the loop (daemon_errors_total, labelled by step)...the daemon carries on regardless
+    def report(self, step, model, error):
+        print('SyncDaemon ' + step + (' ' + model if model else '') + ' failed: ' + type(error).__name__ + ': ' + str(error))
+        self.manager.metrics.increment('daemon_errors_total', step=step, model=model)
+
+
+    # runs until stop() is called
+    # an error in any one step (the database locked by a cron sync for too long, NOMADS misbehaving, a full disk...) is reported and that
+    # step is tried again later, rather than taking the daemon down
+    def run(self):
+        while not self.stopEvent.is_set():
+            now = time.time()
+            try:
+                self.scheduleCycles(datetime.now(timezone.utc))
+            except Exception as e: # picked up again on the next pass
+                self.report('schedule', None, e)
+            try:
+                self.purge(now)
+            except Exception as e:
+                self.report('purge', None, e)
+                self.nextPurge = now + self.manager.constants.get('pollInterval', 120)
+
+            # handle everything that's due
+            while len(self.queue) > 0 and self.queue[0][0] <= time.time():
+                due, model, cyclec, fHour = heapq.heappop(self.queue)
+                self.queued.discard((model, cyclec, fHour))
+                try:
+                    self.check(model, cyclec, fHour, time.time())
+                except Exception as e:
+                    self.report('check', model, e)
+                    if self.inWindow(cyclec):
+                        self.push(time.time() + self.setting(model, 'pollInterval', 120), model, cyclec, fHour)
+
+            # sleep until the next thing is due, but wake up at least every pollInterval to pick up new cycles
+            wake = min([self.queue[0][0] if len(self.queue) > 0 else float('inf'), self.nextPurge, now + self.manager.constants.get('pollInterval', 120)])
+            self.stopEvent.wait(max(wake - time.time(), 0))
+
+
+    def stop(self):
+        self.stopEvent.set()
+
+
+# execute
+# python SyncDaemon.py <config> [1]...the trailing 1 turns on progress output, like GribManager
+def main():
+    configPath = sys.argv[1] if len(sys.argv) >= 2 else '/var/www/html/mike/DBManager/test_config.yml'
+    text = len(sys.argv) >= 3 and sys.argv[2] == "1"
+
+    manager = dbm.DBManager(configPath)
+    daemon = SyncDaemon(manager, text)
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        manager.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+import time
+
+######################################################################
+#   Sync Metrics                                                     #
+#                                                                    #
+#   counters and latency histograms for DBManager, keyed by metric   #
+#   name plus labels (model, cycle, result...), written out after a  #
+#   run as a JSON summary and as a Prometheus textfile               #
+######################################################################
+
+# histogram bucket upper bounds, in seconds...spans a fast sqlite commit up to a request that runs into the NOMADS timeout
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class SyncMetrics:
+
+
+    def __init__(self):
+        self.lock = threading.Lock() # downloads record from worker threads
+        self.counters = {} # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> {'buckets': [...], 'sum': x, 'count': n}
+        self.started = time.time()
+
+
+    # turns keyword labels into a hashable, consistently ordered key
+    def __labelKey(self, labels):
+        return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+    # adds amount to a counter, e.g. increment('grib_downloads_total', model='GEFS', result='ok')
+    def increment(self, name, amount=1, **labels):
+        key = (name, self.__labelKey(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+
+    # records one observation (in seconds) in a latency histogram
+    def observe(self, name, value, **labels):
+        key = (name, self.__labelKey(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+                self.histograms[key] = histogram
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][i] = histogram['buckets'][i] + 1
+            histogram['sum'] = histogram['sum'] + value
+            histogram['count'] = histogram['count'] + 1
+
+
+    # returns everything recorded so far as plain dicts/lists, ready for json.dump()
+    def summary(self):
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())]
+            histograms = []
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                histograms.append({'name': name, 'labels': dict(labels), 'count': histogram['count'], 'sum': round(histogram['sum'], 6),
+                                   'mean': round(histogram['sum'] / histogram['count'], 6) if histogram['count'] else None,
+                                   'buckets': dict(zip([str(b) for b in BUCKETS], histogram['buckets']))})
+        return {'started': self.started, 'finished': time.time(), 'counters': counters, 'histograms': histograms}
+
+
+    # renders everything recorded so far in the Prometheus text exposition format
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for name in sorted(set(name for (name, _) in self.counters)):
+                lines.append('# TYPE ' + name + ' counter')
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(name + self.__formatLabels(labels) + ' ' + str(value))
+            for name in sorted(set(name for (name, _) in self.histograms)):
+                lines.append('# TYPE ' + name + ' histogram')
+                for (n, labels), histogram in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, count in zip(BUCKETS, histogram['buckets']):
+                        lines.append(name + '_bucket' + self.__formatLabels(labels + (('le', str(bound)),)) + ' ' + str(count))
+                    lines.append(name + '_bucket' + self.__formatLabels(labels + (('le', '+Inf'),)) + ' ' + str(histogram['count']))
+                    lines.append(name + '_sum' + self.__formatLabels(labels) + ' ' + repr(histogram['sum']))
+                    lines.append(name + '_count' + self.__formatLabels(labels) + ' ' + str(histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+
+    def __formatLabels(self, labels):
+        if len(labels) == 0:
+            return ''
+        return '{' + ','.join(k + '="' + v.replace('\\', '\\\\').replace('"', '\\"') + '"' for k, v in labels) + '}'
+
+
+    # writes the JSON summary to path
+    def writeJson(self, path):
+        self.__writeAtomic(path, json.dumps(self.summary(), indent=2))
+
+
+    # writes the Prometheus textfile to path (for node_exporter's textfile collector, which wants a *.prom file)
+    def writePrometheus(self, path):
+        self.__writeAtomic(path, self.prometheus())
+
+
+    # writes via a temp file and a rename, so a scraper never reads a half-written file
+    def __writeAtomic(self, path, text):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tempPath = path + '.tmp'
+        with open(tempPath, 'w') as outFile:
+            outFile.write(text)
+        os.replace(tempPath, path)
@@ -1,8 +1,12 @@
 HOME_PREFIX="/var/www/html/mike/DBManager/"
 HOME_DATABASE="base.db"
+HOME_CONFIG="test_config.yml"
 
 DEST_PREFIX="/var/www/html/mike/GEPSSoundings/"
 
-cp ${HOME_PREFIX}${HOME_DATABASE} ${DEST_PREFIX}${HOME_DATABASE} 2>&1
+# GribManager publishes a snapshot on its own after every sync when snapshotDest is set in the config...this is for doing it by hand
+# a plain cp can catch base.db mid-transaction (or miss whatever is still in base.db-wal), so the copy goes through sqlite's online
+# backup API instead and is renamed into place once it's complete
+cd ${HOME_PREFIX} && python3 -c "import DBManager as dbm; manager = dbm.DBManager('${HOME_CONFIG}'); print(manager.publishSnapshot('${DEST_PREFIX}${HOME_DATABASE}')); manager.close()" 2>&1
 
 echo "Script copy_db.sh complete."
@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+# the modules live at the top of the repo rather than in a package
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from NomadsStandin import NomadsStandin
+import DBManager as dbm
+
+
+# a NOMADS stand-in on a free port, publishing every cycle...parametrize it (indirect) with a set of files to leave unpublished
+@pytest.fixture
+def standin(request):
+    missing = getattr(request, 'param', None)
+    server = NomadsStandin(size=1024, missing=missing).start()
+    yield server
+    server.stop()
+
+
+# a DBManager on test_config.yml, pointed at the stand-in, with its archive and database under tmp_path and small ensembles
+# every test runs with the inventory cache on and off, since the two answer lookups and plan downloads differently
+@pytest.fixture(params=[True, False], ids=['cached', 'uncached'])
+def manager(request, standin, tmp_path):
+    configPath = standin.writeConfig(os.path.join(REPO, 'test_config.yml'), str(tmp_path / 'config.yml'), str(tmp_path / 'grib') + '/',
+                                     str(tmp_path / 'base.db'), {'workers': 4, 'retries': 0, 'imgSrc': str(tmp_path / 'images') + '/', 'inventoryCache': request.param},
+                                     {'GEFS': {'members': 2, 'fHours': 24}, 'GEPS': {'members': 2, 'fHours': 24}})
+    manager = dbm.DBManager(configPath)
+    yield manager
+    manager.close()
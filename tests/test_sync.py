@@ -0,0 +1,100 @@
+import os
+import sqlite3
+
+import pytest
+
+CYCLE = '2022101500'
+LATER = '2022101512'
+FILES = 9 # control + 2 members, f000/f012/f024
+
+
+def download(manager, cyclec, model='GEFS'):
+    return manager.downloadModel(model, cyclec[0:8], int(cyclec[8:]))
+
+
+def test_download_model_fetches_every_file(manager):
+    summary = download(manager, CYCLE)
+    assert len(summary['succeeded']) == FILES
+    assert summary['failed'] == []
+    assert manager.getMissingGribs('GEFS', [CYCLE]) == {CYCLE: []}
+    for row in manager.listAllGribs():
+        assert os.path.getsize(row[4]) == 1024
+
+
+@pytest.mark.parametrize('standin', [{(CYCLE, 'gep02', 12)}], indirect=True)
+def test_missing_gribs_lists_unpublished_files(manager):
+    summary = download(manager, CYCLE)
+    assert summary['failed'] == [(2, 12)]
+    assert manager.getMissingGribs('GEFS', [CYCLE, LATER]) == {CYCLE: [(2, 12)], LATER: sorted((j, i) for i in (0, 12, 24) for j in (-1, 1, 2))}
+
+
+def test_delete_old_gribs_purges_whole_cycles(manager):
+    download(manager, CYCLE)
+    download(manager, LATER)
+    summary = manager.deleteOldGribs(LATER, 'GEFS')
+    assert summary['rows'] == FILES
+    assert summary['files'] == FILES
+    assert not os.path.exists(os.path.join(manager.constants['rootSrc'], 'GEFS', CYCLE))
+    assert manager.getModelCycles('GEFS') == [LATER]
+    assert len(manager.getMissingGribs('GEFS', [CYCLE])[CYCLE]) == FILES
+
+
+def test_publish_snapshot_is_a_complete_standalone_copy(manager, tmp_path):
+    download(manager, CYCLE)
+    dest = str(tmp_path / 'site' / 'base.db')
+    summary = manager.publishSnapshot(dest, pages=1)
+    assert summary['path'] == dest
+    assert not os.path.exists(dest + '.part')
+    snapshot = sqlite3.connect(dest)
+    try:
+        assert snapshot.execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+        assert snapshot.execute('PRAGMA integrity_check').fetchone()[0] == 'ok'
+        assert snapshot.execute('SELECT COUNT(*) FROM grib').fetchone()[0] == FILES
+    finally:
+        snapshot.close()
+
+
+def test_reconcile_archive_is_clean_after_a_sync(manager):
+    download(manager, CYCLE)
+    summary = manager.reconcileArchive()
+    assert summary['scanned'] == FILES
+    for key in ('missing', 'corrupt', 'orphans', 'partials'):
+        assert summary[key] == []
+
+
+def test_reconcile_archive_repairs_drift(manager):
+    download(manager, CYCLE)
+    rows = {(row[2], row[3]): row[4] for row in manager.listAllGribs()}
+    with open(rows[(1, 0)], 'r+b') as truncated:
+        truncated.truncate(100)
+    os.remove(rows[(2, 12)])
+    junk = os.path.join(os.path.dirname(rows[(1, 0)]), 'junk.grib')
+    with open(junk, 'wb') as orphan:
+        with open(rows[(-1, 0)], 'rb') as intact:
+            orphan.write(intact.read())
+    stale = rows[(2, 24)] + '.part'
+    with open(stale, 'wb') as partial:
+        partial.write(b'GRIB')
+    os.utime(stale, (0, 0))
+
+    summary = manager.reconcileArchive(repair=True)
+    assert summary['missing'] == [rows[(2, 12)]]
+    assert summary['corrupt'] == [(rows[(1, 0)], 'truncated')]
+    assert summary['orphans'] == [junk]
+    assert summary['partials'] == [stale]
+    assert summary['errors'] == []
+    assert not os.path.exists(junk) and not os.path.exists(stale) and not os.path.exists(rows[(1, 0)])
+
+    # the broken files are back on the to-do list, and a second pass finds nothing
+    assert manager.getMissingGribs('GEFS', [CYCLE]) == {CYCLE: [(1, 0), (2, 12)]}
+    summary = manager.reconcileArchive()
+    for key in ('missing', 'corrupt', 'orphans', 'partials'):
+        assert summary[key] == []
+
+
+def test_queued_downloads_are_visible_before_they_are_committed(manager):
+    path = manager.downloadGrib('GEFS', CYCLE[0:8], int(CYCLE[8:]), 1, 12) # one file on its own stays queued in the writer
+    assert len(manager.writer.pending) > 0
+    assert manager.checkForFile('GEFS', CYCLE[0:8], int(CYCLE[8:]), 1, 12) == (True, path)
+    assert manager.getModelCycles('GEFS') == [CYCLE]
+    assert (1, 12) not in manager.getMissingGribs('GEFS', [CYCLE])[CYCLE]